@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks of the chat datasource and captive portal hot functions
+
+Each function is timed against synthetic data of several sizes, so it
+shows how its cost grows with the number of chat messages or captive
+portal clients. Nothing needs a device: the chat database is built in a
+temporary directory and the dnsmasq config is a temporary file. Results
+(median and best microseconds per call, for each function and size) are
+printed as JSON, and a table of them goes to stderr:
+
+    python3 benchmarks/micro.py --output micro.json
+    python3 benchmarks/micro.py --baseline micro.json
+
+With --baseline, the exit status is 1 if any function got slower than in
+the earlier run by more than --tolerance. Building the 1M message
+database takes a while (and ~100MB of disk), so --messages and --clients
+pick other sizes, e.g. --messages 1000,100000 for a quick run.
+"""
+
+import argparse
+import configparser
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+import probe_load
+
+APP_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, "python")
+sys.path.insert(0, APP_DIRECTORY)
+
+from captive_portal import manager  # noqa: E402
+from captive_portal.clients import create_registry  # noqa: E402
+from chat import datasource  # noqa: E402
+
+MESSAGE_COUNTS = [1000, 100000, 1000000]
+CLIENT_COUNTS = [10, 100, 1000, 10000]
+# Share of the synthetic messages old enough for delete_records to expire
+EXPIRED_FRACTION = 0.1
+# Each measurement makes enough calls to take at least this long, and is
+#  repeated REPEATS times
+MIN_MEASURE_SECS = 0.2
+REPEATS = 5
+DNSMASQ_CONF = "dhcp-range=10.129.0.2,10.129.0.250,255.255.255.0,300\n"
+
+
+def measure(func, min_secs=MIN_MEASURE_SECS, repeats=REPEATS):
+    """Median and best seconds per call of func()"""
+    start = time.perf_counter()
+    func()
+    first_secs = time.perf_counter() - start
+    calls = max(1, int(min_secs / max(first_secs, 1e-7)))
+    per_call = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(calls):
+            func()
+        per_call.append((time.perf_counter() - start) / calls)
+    return statistics.median(per_call), min(per_call), calls * repeats
+
+
+def measure_once(func):
+    """Seconds taken by a single call of func(), for destructive calls"""
+    start = time.perf_counter()
+    func()
+    elapsed_secs = time.perf_counter() - start
+    return elapsed_secs, elapsed_secs, 1
+
+
+class Results(object):
+    """Timings by benchmark name and data size"""
+
+    def __init__(self):
+        self.benchmarks = {}
+
+    def add(self, name, size, timing):
+        median_secs, best_secs, calls = timing
+        self.benchmarks.setdefault(name, {})[str(size)] = {
+            "per_call_us": round(median_secs * 1e6, 2),
+            "best_us": round(best_secs * 1e6, 2),
+            "calls": calls,
+        }
+        sys.stderr.write("%-45s %8s %12.2fus\n" % (name, size,
+                                                   median_secs * 1e6))
+
+    def as_dict(self):
+        return {
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "machine": platform.machine(),
+            "benchmarks": self.benchmarks,
+        }
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    """Functions that got slower than in baseline, as readable strings"""
+    regressions = []
+    for name, sizes in sorted(baseline.get("benchmarks", {}).items()):
+        for size, before in sorted(sizes.items()):
+            after = results["benchmarks"].get(name, {}).get(size)
+            if after is None:
+                continue
+            if after["per_call_us"] > before["per_call_us"] * (1 + tolerance):
+                regressions.append("%s at %s: %.2fus, was %.2fus" % (
+                    name, size, after["per_call_us"], before["per_call_us"]))
+    return regressions
+
+
+def chat_sqlite_pragmas():
+    """The pragmas set by defaults.cfg, as main.py would read them"""
+    config_parser = configparser.ConfigParser()
+    config_parser.read(os.path.join(APP_DIRECTORY, "defaults.cfg"))
+    return [(pragma, config_parser.get("chat", "SQLITE_%s" % pragma.upper()))
+            for pragma in datasource.TUNABLE_PRAGMAS]
+
+
+def populate_messages(db_path, count):
+    """Fill the messages table with count messages, oldest first
+
+    The first EXPIRED_FRACTION of them are older than delete_records'
+    default age, and the rest were posted over the last two hours.
+    """
+    now = int(time.time())
+    expired = int(count * EXPIRED_FRACTION)
+
+    def rows():
+        for n in range(count):
+            if n < expired:
+                created = now - 4 * 3600 + n * 1800 // max(expired, 1)
+            else:
+                created = now - 2 * 3600 + \
+                    (n - expired) * 7200 // max(count - expired, 1)
+            yield ("nick%d" % (n % 50,),
+                   "Message number %d from the synthetic dataset" % (n,),
+                   "rtl" if n % 5 == 0 else "ltr", created)
+
+    conn = sqlite3.connect(db_path)
+    with conn:
+        conn.executemany(
+            "INSERT INTO messages (nick, message, textDirection, created)"
+            " VALUES (?, ?, ?, ?)", rows())
+    conn.close()
+
+
+def benchmark_chat(results, count, directory):
+    db_path = os.path.join(directory, "cbchat-%d.db" % (count,))
+    datasource.open_connection("sqlite:///%s" % (db_path,),
+                               chat_sqlite_pragmas())
+    datasource.setup()
+    populate_messages(db_path, count)
+    try:
+        newest = datasource.latest_message_id()
+        results.add("chat.query_messages[newest]", count,
+                    measure(datasource.query_messages))
+        results.add("chat.query_messages[since]", count,
+                    measure(lambda: datasource.query_messages(
+                        since=newest - 10)))
+        results.add("chat.query_messages[before_id]", count,
+                    measure(lambda: datasource.query_messages(
+                        before_id=newest // 2)))
+        results.add("chat.query_messages[offset]", count,
+                    measure(lambda: datasource.query_messages(
+                        offset=count // 2)))
+        results.add("chat.record_count", count,
+                    measure(datasource.record_count))
+        results.add("chat.query_defaultTextDirection", count,
+                    measure(datasource.query_defaultTextDirection))
+        results.add("chat.insert_message", count,
+                    measure(lambda: datasource.insert_message(
+                        "bench", "A new message", "ltr")))
+        results.add("chat.delete_records[backlog]", count,
+                    measure_once(datasource.delete_records))
+        results.add("chat.delete_records[nothing_expired]", count,
+                    measure(datasource.delete_records))
+    finally:
+        datasource.shutdown()
+        datasource.close()
+        # Nothing left for the shutdown registered by setup() to do
+        datasource.DATASOURCE = None
+        os.remove(db_path)
+
+
+def _client_address(n):
+    return "10.129.%d.%d" % (n // 250, n % 250 + 2)
+
+
+def _user_agent(n):
+    """A browser user agent, distinct for each n"""
+    return "Mozilla/5.0 (Linux; Android %d.0; Device%d Build/NRD%dM) " \
+        "AppleWebKit/537.36 (KHTML, like Gecko) Chrome/%d.0.%d.%d " \
+        "Mobile Safari/537.36" % (5 + n % 5, n, n % 100, 50 + n % 20,
+                                  n % 4000, n % 150)
+
+
+def benchmark_captive_portal(results, count, directory):
+    # A client probes with whatever user agents its browsers send, so
+    #  there are as many distinct user agents as clients (or more)
+    user_agents = [_user_agent(n) for n in range(count)]
+    manager.configure_link_type_cache(manager.LINK_TYPE_CACHE_SIZE)
+    remaining = []
+
+    def next_link_type():
+        if not remaining:
+            remaining.extend(user_agents)
+            random.shuffle(remaining)
+        manager.get_link_type(remaining.pop())
+    results.add("captive_portal.get_link_type", count,
+                measure(next_link_type))
+
+    addresses = [_client_address(n) for n in range(count)]
+    for backend in ("memory", "sqlite"):
+        db_path = os.path.join(directory, "cbclients-%s.db" % (backend,))
+        manager._client_registry = create_registry(
+            backend, manager.get_dhcp_lease_secs, max(count, 4096), db_path)
+        for address in addresses:
+            manager.register_client(address)
+        results.add("captive_portal.is_recent_authorised_client[%s]" % (
+            backend,), count,
+            measure(lambda: manager.is_recent_authorised_client(
+                random.choice(addresses))))
+        for path in (db_path, db_path + "-wal", db_path + "-shm"):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--messages", default=",".join(
+        str(count) for count in MESSAGE_COUNTS),
+        help="comma separated chat message counts")
+    parser.add_argument("--clients", default=",".join(
+        str(count) for count in CLIENT_COUNTS),
+        help="comma separated captive portal client counts")
+    probe_load.add_output_arguments(parser)
+    args = parser.parse_args(argv)
+
+    results = Results()
+    directory = tempfile.mkdtemp(prefix="connectbox-bench-")
+    try:
+        manager.DNSMASQ_CONF_FILE = os.path.join(directory, "dnsmasq.conf")
+        with open(manager.DNSMASQ_CONF_FILE, "w") as dnsmasq_conf:
+            dnsmasq_conf.write(DNSMASQ_CONF)
+        results.add("captive_portal.get_dhcp_lease_secs", 1,
+                    measure(manager.get_dhcp_lease_secs))
+        for count in [int(count) for count in args.clients.split(",")]:
+            benchmark_captive_portal(results, count, directory)
+        for count in [int(count) for count in args.messages.split(",")]:
+            benchmark_chat(results, count, directory)
+    finally:
+        shutil.rmtree(directory)
+    return probe_load.report(results.as_dict(), args, compare_to_baseline)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+"""
+Load generator for the captive portal probe endpoints
+
+Many simulated clients send captive portal probes to a running ConnectBox
+(or a local gunicorn) as fast as they can, each over its own keep-alive
+connection, while optional background clients hold chat long-polls open
+and read admin properties, the way a busy room would. At the end the
+throughput and p50/p95/p99 latency of the probes are printed as JSON, so
+a gunicorn configuration can be compared against another:
+
+    python3 benchmarks/probe_load.py --clients 50 --duration 30 \\
+        http://192.168.88.1
+
+Admin reads need --admin-auth user:password when going through nginx.
+Each simulated client sends its own X-Forwarded-For, as nginx would for
+a device, so the app can also be loaded directly (e.g. a local gunicorn
+on port 5000); through nginx, the real address is appended to it.
+Responses with a 4xx or 5xx status count as errors, not as latencies.
+With --baseline, the results are compared against an earlier run's JSON
+and the exit status is 1 if any endpoint has regressed.
+"""
+
+import argparse
+import base64
+import http.client
+import json
+import random
+import sys
+import threading
+import time
+import urllib.parse
+
+# (path, User-Agent) of the probes sent by the clients
+PROBES = [
+    ("/hotspot-detect.html", "CaptiveNetworkSupport-346.50.1 wispr"),
+    ("/generate_204", "Dalvik/2.1.0 (Linux; U; Android 7.0; SM-G930F "
+                      "Build/NRD90M)"),
+    ("/ncsi.txt", "Microsoft NCSI"),
+]
+
+
+def client_address(n):
+    """The address of the nth simulated client, as nginx would forward it"""
+    return "10.%d.%d.%d" % ((n >> 16) & 255, (n >> 8) & 255, n & 255)
+
+
+def percentile(sorted_values, fraction):
+    """The value below which fraction of sorted_values lie"""
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1,
+                int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarise(latencies, errors, elapsed_secs):
+    """Throughput and latency percentiles (in ms) of one kind of request"""
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "requests_per_sec": round(len(latencies) / elapsed_secs, 1),
+        "p50_ms": _ms(percentile(latencies, 0.50)),
+        "p95_ms": _ms(percentile(latencies, 0.95)),
+        "p99_ms": _ms(percentile(latencies, 0.99)),
+        "max_ms": _ms(latencies[-1] if latencies else None),
+    }
+
+
+def _ms(secs):
+    return None if secs is None else round(secs * 1000, 2)
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    """Endpoints that did worse than in baseline, as readable strings
+
+    An endpoint has regressed if its p99 latency rose, or its throughput
+    fell, by more than tolerance (a fraction) of the baseline's, or if
+    any of its requests failed.
+    """
+    regressions = []
+    for name, before in sorted(baseline.get("endpoints", {}).items()):
+        after = results["endpoints"].get(name)
+        if after is None:
+            regressions.append("%s: not measured" % (name,))
+            continue
+        if before["p99_ms"] is not None and after["p99_ms"] is not None and \
+                after["p99_ms"] > before["p99_ms"] * (1 + tolerance):
+            regressions.append("%s: p99 %.2fms, was %.2fms" % (
+                name, after["p99_ms"], before["p99_ms"]))
+        if after["requests_per_sec"] < \
+                before["requests_per_sec"] * (1 - tolerance):
+            regressions.append("%s: %.1f requests/s, was %.1f" % (
+                name, after["requests_per_sec"], before["requests_per_sec"]))
+        if after["errors"]:
+            regressions.append("%s: %d errors, was %d" % (
+                name, after["errors"], before["errors"]))
+    for name, after in sorted(results["endpoints"].items()):
+        if name not in baseline.get("endpoints", {}) and after["errors"]:
+            regressions.append("%s: %d errors" % (name, after["errors"]))
+    return regressions
+
+
+def add_output_arguments(parser):
+    parser.add_argument("--output", help="also write the results here")
+    parser.add_argument("--baseline",
+                        help="results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="fraction a measure may worsen by before it "
+                             "counts as a regression")
+
+
+def report(results, args, compare=compare_to_baseline):
+    """Print (and save) results, returning the exit status
+
+    compare(results, baseline, tolerance) lists the regressions.
+    """
+    json.dump(results, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write("\n")
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    if not args.baseline:
+        return 0
+    with open(args.baseline) as baseline_file:
+        regressions = compare(results, json.load(baseline_file),
+                              args.tolerance)
+    for regression in regressions:
+        sys.stderr.write("REGRESSION %s\n" % (regression,))
+    return 1 if regressions else 0
+
+
+class Recorder(object):
+    """Latencies and error counts, collected from every client thread"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+
+    def record(self, name, latency_secs):
+        with self._lock:
+            self.latencies.setdefault(name, []).append(latency_secs)
+
+    def error(self, name):
+        with self._lock:
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+
+class Client(object):
+    """One simulated device, with its own keep-alive connection
+
+    If address is given, it's sent as X-Forwarded-For unless a request
+    gives its own.
+    """
+
+    def __init__(self, base_url, recorder, timeout_secs, address=None):
+        parsed = urllib.parse.urlsplit(base_url)
+        self._host = parsed.hostname
+        self._port = parsed.port or 80
+        self._prefix = parsed.path.rstrip("/")
+        self._recorder = recorder
+        self._timeout_secs = timeout_secs
+        self._headers = {} if address is None else \
+            {"X-Forwarded-For": address}
+        self._conn = None
+
+    def request(self, name, path, headers=None):
+        """GET path, recording its latency under name. Returns the status
+
+        Failed requests, including those answered with a 4xx or 5xx
+        status, are counted as errors under name instead.
+        """
+        start = time.perf_counter()
+        try:
+            if self._conn is None:
+                self._conn = http.client.HTTPConnection(
+                    self._host, self._port, timeout=self._timeout_secs)
+            self._conn.request("GET", self._prefix + path,
+                               headers=dict(self._headers, **(headers or {})))
+            response = self._conn.getresponse()
+            response.read()
+            if response.will_close:
+                self._conn.close()
+                self._conn = None
+        except (OSError, http.client.HTTPException):
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+            self._recorder.error(name)
+            return None
+        if response.status >= 400:
+            self._recorder.error(name)
+        else:
+            self._recorder.record(name, time.perf_counter() - start)
+        return response.status
+
+
+def run_probe_client(client, stop):
+    while not stop.is_set():
+        path, user_agent = random.choice(PROBES)
+        client.request(path, path, {"User-Agent": user_agent})
+
+
+def run_long_poll_client(client, stop):
+    while not stop.is_set():
+        client.request("/chat/messages/stream",
+                       "/chat/messages/stream?max_id=%d" % (2 ** 31,))
+
+
+def run_admin_client(client, stop, auth):
+    headers = {"Authorization": "Basic " +
+               base64.b64encode(auth.encode("utf-8")).decode("ascii")}
+    while not stop.is_set():
+        client.request("/admin/api/ssid", "/admin/api/ssid", headers)
+
+
+def run(base_url, clients, duration_secs, long_polls=0, admin_clients=0,
+        admin_auth=None, timeout_secs=30):
+    """Run the load for duration_secs, returning the results as a dict"""
+    recorder = Recorder()
+    stop = threading.Event()
+    threads = []
+
+    def start(target, *args):
+        client = Client(base_url, recorder, timeout_secs,
+                        client_address(len(threads) + 1))
+        thread = threading.Thread(target=target, args=(client, stop) + args)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    for _ in range(long_polls):
+        start(run_long_poll_client)
+    for _ in range(admin_clients):
+        start(run_admin_client, admin_auth or "")
+    for _ in range(clients):
+        start(run_probe_client)
+
+    started = time.perf_counter()
+    time.sleep(duration_secs)
+    stop.set()
+    elapsed_secs = time.perf_counter() - started
+    for thread in threads:
+        thread.join(timeout_secs)
+
+    probe_names = set(path for path, _ in PROBES)
+    all_probes = [latency for name, latencies in recorder.latencies.items()
+                  if name in probe_names for latency in latencies]
+    probe_errors = sum(count for name, count in recorder.errors.items()
+                       if name in probe_names)
+    names = set(recorder.latencies) | set(recorder.errors)
+    return {
+        "base_url": base_url,
+        "clients": clients,
+        "long_polls": long_polls,
+        "admin_clients": admin_clients,
+        "duration_secs": round(elapsed_secs, 1),
+        "probes": summarise(all_probes, probe_errors, elapsed_secs),
+        "endpoints": dict(
+            (name, summarise(recorder.latencies.get(name, []),
+                             recorder.errors.get(name, 0), elapsed_secs))
+            for name in sorted(names)),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("base_url", help="e.g. http://192.168.88.1")
+    parser.add_argument("--clients", type=int, default=20,
+                        help="clients sending probes")
+    parser.add_argument("--duration", type=float, default=10,
+                        help="seconds to run for")
+    parser.add_argument("--long-polls", type=int, default=0,
+                        help="clients holding chat long-polls open")
+    parser.add_argument("--admin-clients", type=int, default=0,
+                        help="clients reading an admin property")
+    parser.add_argument("--admin-auth", help="user:password for admin reads")
+    add_output_arguments(parser)
+    args = parser.parse_args(argv)
+    results = run(args.base_url, args.clients, args.duration,
+                  args.long_polls, args.admin_clients, args.admin_auth)
+    return report(results, args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
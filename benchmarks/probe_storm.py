@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""
+Offline captive portal probe storm
+
+Starts main:app in this process, behind a threaded werkzeug server, with
+a stub standing in for nginx's /to-hostname redirect, so no device is
+needed. Simulated devices then join the network as fast as they can,
+each from a new address, and replay the probes their OS sends when it
+joins: iOS and macOS hotspot-detect.html (wispr, then the browser, then
+wispr again), Android generate_204 and gen_204, Windows ncsi.txt and
+Kindle wifistub.html. Throughput and p50/p95/p99 latency are reported
+per endpoint as JSON, and can be compared against an earlier run.
+Answers with a 4xx or 5xx status count as errors, and any error fails
+the comparison:
+
+    python3 benchmarks/probe_storm.py --clients 50 --duration 30 \\
+        --output storm.json
+    python3 benchmarks/probe_storm.py --clients 50 --duration 30 \\
+        --baseline storm.json
+
+The load generator shares the interpreter with the app, so results are
+only comparable between runs on the same machine. --base-url sends the
+same storm to a running ConnectBox instead.
+"""
+
+import argparse
+import collections
+import http.server
+import itertools
+import logging
+import os
+import random
+import sys
+import threading
+import time
+
+import probe_load
+
+APP_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, "python")
+STUB_CONNECTBOX_URL = "http://connectbox.local/"
+
+IOS_WISPR_UA = "CaptiveNetworkSupport-346.50.1 wispr"
+IOS_BROWSER_UA = "Mozilla/5.0 (iPhone; CPU iPhone OS 10_3_1 like Mac OS X) " \
+    "AppleWebKit/603.1.30 (KHTML, like Gecko) Mobile/14E304"
+MACOS_BROWSER_UA = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_12_4) " \
+    "AppleWebKit/603.1.30 (KHTML, like Gecko)"
+ANDROID_UA = "Dalvik/2.1.0 (Linux; U; Android 7.0; SM-G930F Build/NRD90M)"
+WINDOWS_UA = "Microsoft NCSI"
+KINDLE_UA = "Mozilla/5.0 (Linux; U; Android 4.0.3; en-us; KFTT " \
+    "Build/IML74K) AppleWebKit/535.19 (KHTML, like Gecko) Silk/3.4 " \
+    "Mobile Safari/535.19 Silk-Accelerated=true"
+
+# OS -> (share of joining devices, [(path, User-Agent)] sent on joining)
+PROBE_SEQUENCES = {
+    "ios": (35, [
+        ("/hotspot-detect.html", IOS_WISPR_UA),
+        ("/hotspot-detect.html", IOS_BROWSER_UA),
+        ("/hotspot-detect.html", IOS_WISPR_UA),
+    ]),
+    "ios_lt_9": (5, [
+        ("/library/test/success.html", IOS_WISPR_UA),
+        ("/library/test/success.html", IOS_WISPR_UA),
+    ]),
+    "macos": (5, [
+        ("/hotspot-detect.html", IOS_WISPR_UA),
+        ("/hotspot-detect.html", MACOS_BROWSER_UA),
+        ("/hotspot-detect.html", IOS_WISPR_UA),
+    ]),
+    "android": (35, [
+        ("/generate_204", ANDROID_UA),
+        ("/gen_204", ANDROID_UA),
+        ("/generate_204", ANDROID_UA),
+    ]),
+    "windows": (15, [
+        ("/ncsi.txt", WINDOWS_UA),
+        ("/ncsi.txt", WINDOWS_UA),
+    ]),
+    "kindle": (5, [
+        ("/kindle-wifi/wifistub.html", KINDLE_UA),
+    ]),
+}
+
+
+class ToHostnameStub(http.server.BaseHTTPRequestHandler):
+    """Answers like nginx's default vhost /to-hostname redirect"""
+
+    lookups = 0
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        ToHostnameStub.lookups += 1
+        self.send_response(302)
+        self.send_header("Location", STUB_CONNECTBOX_URL)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def _serve_in_background(server):
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+
+def start_local_app():
+    """Start the stub and main:app, returning the app's base URL"""
+    stub = http.server.HTTPServer(("127.0.0.1", 0), ToHostnameStub)
+    _serve_in_background(stub)
+
+    sys.path.insert(0, APP_DIRECTORY)
+    from captive_portal import manager
+    # Set before main starts looking the URL up
+    manager.REAL_HOST_REDIRECT_URL = "http://127.0.0.1:%d/to-hostname" % (
+        stub.server_port,)
+    import main
+    from werkzeug.serving import make_server
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", 0, main.app, threaded=True)
+    _serve_in_background(server)
+    return "http://127.0.0.1:%d" % (server.server_port,)
+
+
+def _client_addresses():
+    """A new address for each joining device"""
+    for n in itertools.count(1):
+        yield probe_load.client_address(n)
+
+
+def run_storm_client(client, stop, next_address, joins, joins_lock):
+    systems = sorted(PROBE_SEQUENCES)
+    weights = [PROBE_SEQUENCES[system][0] for system in systems]
+    while not stop.is_set():
+        system = random.choices(systems, weights)[0]
+        address = next_address()
+        for path, user_agent in PROBE_SEQUENCES[system][1]:
+            client.request(path, path, {"User-Agent": user_agent,
+                                        "X-Forwarded-For": address})
+        with joins_lock:
+            joins[system] += 1
+
+
+def run(base_url, clients, duration_secs, timeout_secs=30):
+    """Run the storm for duration_secs, returning the results as a dict"""
+    recorder = probe_load.Recorder()
+    joins = collections.Counter()
+    joins_lock = threading.Lock()
+    stop = threading.Event()
+    addresses = _client_addresses()
+    address_lock = threading.Lock()
+
+    def next_address():
+        # Generators can't be advanced from two threads at once
+        with address_lock:
+            return next(addresses)
+
+    threads = []
+    for _ in range(clients):
+        client = probe_load.Client(base_url, recorder, timeout_secs)
+        thread = threading.Thread(target=run_storm_client,
+                                  args=(client, stop, next_address, joins,
+                                        joins_lock))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    started = time.perf_counter()
+    time.sleep(duration_secs)
+    stop.set()
+    elapsed_secs = time.perf_counter() - started
+    for thread in threads:
+        thread.join(timeout_secs)
+
+    all_latencies = [latency for latencies in recorder.latencies.values()
+                     for latency in latencies]
+    names = set(recorder.latencies) | set(recorder.errors)
+    return {
+        "base_url": base_url,
+        "clients": clients,
+        "duration_secs": round(elapsed_secs, 1),
+        "joins": dict((system, joins[system])
+                      for system in sorted(PROBE_SEQUENCES)),
+        "probes": probe_load.summarise(
+            all_latencies, sum(recorder.errors.values()), elapsed_secs),
+        "endpoints": dict(
+            (name, probe_load.summarise(recorder.latencies.get(name, []),
+                                        recorder.errors.get(name, 0),
+                                        elapsed_secs))
+            for name in sorted(names)),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--clients", type=int, default=20,
+                        help="devices joining at once")
+    parser.add_argument("--duration", type=float, default=10,
+                        help="seconds to run for")
+    parser.add_argument("--base-url",
+                        help="storm this ConnectBox instead of a local app")
+    probe_load.add_output_arguments(parser)
+    args = parser.parse_args(argv)
+    base_url = args.base_url or start_local_app()
+    results = run(base_url, args.clients, args.duration)
+    if not args.base_url:
+        results["base_url"] = "local"
+        results["to_hostname_lookups"] = ToHostnameStub.lookups
+    return probe_load.report(results, args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
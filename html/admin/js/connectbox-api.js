@@ -20,6 +20,43 @@ var ConnectBoxApp = (function (App, $) {
     }
   }
 
+  // How often to check on a property write running in the background
+  var JOB_POLL_MS = 1000
+
+  function handleResult (data, callback) {
+    if (data.code === 0) {
+      if (callback) {
+        callback(data.result)
+      }
+    } else {
+      if (callback) {
+        callback(null, data.code, data.result)
+      }
+    }
+  }
+
+  function waitForJob (jobId, callback) {
+    $.ajax({
+      url: buildApiUrl('jobs/' + jobId),
+      method: 'GET',
+      success: function (data, textStatus, jqXHR) {
+        var job = data.result
+        if (job.status === 'queued' || job.status === 'running') {
+          setTimeout(function () { waitForJob(jobId, callback) }, JOB_POLL_MS)
+        } else if (job.status === 'done') {
+          handleResult(job, callback)
+        } else if (callback) {
+          callback(null, 500, 'Setting property did not finish')
+        }
+      },
+      error: function (jqXHR, textStatus, errorThrown) {
+        if (callback) {
+          callback(null, 500, 'Unexpected error setting property: ' + textStatus)
+        }
+      }
+    })
+  }
+
   App.api = {
     getProperty: function (propertyName, callback) {
       $.ajax({
@@ -50,17 +87,16 @@ var ConnectBoxApp = (function (App, $) {
         url: buildApiUrl(propertyName, {}),
         method: 'PUT',
         dataType: 'json',
+        // Run the write in the background and follow it, except for the
+        //  password: once it is set, the old one can't fetch the job
+        headers: propertyName === 'password' ? {} : {'Prefer': 'respond-async'},
         data: wrap ? '{"value": "' + propertyValue + '"}' : propertyValue,
         success: function (data, textStatus, jqXHR) {
           window.mydata = data
-          if (data.code === 0) {
-            if (callback) {
-              callback(data.result)
-            }
+          if (jqXHR.status === 202) {
+            waitForJob(data.result.job, callback)
           } else {
-            if (callback) {
-              callback(null, data.code, data.result)
-            }
+            handleResult(data, callback)
           }
         },
         error: function (jqXHR, textStatus, errorThrown) {
@@ -1,29 +1,192 @@
-import os,subprocess,json
-from flask import Flask,request,abort,jsonify,make_response
+import functools,os,subprocess,json,time
+from flask import Flask,current_app,request,abort,make_response
+from jsonresponse import json_response
+import metrics
+from admin import config_reader
+from admin.jobs import JobRunner, script_lock
 
 valid_properties = ["ssid", "channel", "hostname", "staticsite", "password", "system", "ui-config"]
+_property_change_listeners = []
+# Longest a manage script command may run before it is stopped
+COMMAND_TIMEOUT_SECS = 120
+# How long a stopped command gets to clean up before it is killed
+COMMAND_KILL_GRACE_SECS = 5
+# Exit code reported for commands that were stopped, as timeout(1) does
+TIMED_OUT_CODE = 124
+# What the manage script prints (exiting 0) if another copy holds its own
+#  lock, e.g. one run by hand, or one whose lock was left by a kill
+SCRIPT_BUSY_OUTPUT = "Script is already running"
+SCRIPT_BUSY_RETRIES = 3
+SCRIPT_BUSY_RETRY_SECS = 1
+# Exit code reported when the manage script stayed busy
+SCRIPT_BUSY_CODE = 1
+# Key of this module's settings in app.extensions
+EXTENSION_KEY = "connectbox_admin"
 
 def _abort_bad_request():
     abort(make_response("BAD REQUEST", 400))
     
 
-def _call_command(extra_args):
+def add_property_change_listener(listener):
+    """Call listener(prop) whenever a property is successfully set"""
+    _property_change_listeners.append(listener)
+
+
+def _notify_property_changed(prop):
+    for listener in _property_change_listeners:
+        listener(prop)
+
+
+def _settings():
+    return current_app.extensions[EXTENSION_KEY]
+
+
+def _run_command(extra_args, timeout_secs):
+    """Run the manage script, returning its exit code and output lines
+
+    Runs hold script_lock(), so they don't find another copy running. If
+    one is found anyway, we try again, then report a failure rather than
+    the script's exit code of 0.
+    """
+    for attempt in range(SCRIPT_BUSY_RETRIES + 1):
+        if attempt:
+            time.sleep(SCRIPT_BUSY_RETRY_SECS)
+        with script_lock():
+            code, result = _run_command_locked(extra_args, timeout_secs)
+        if result != [SCRIPT_BUSY_OUTPUT]:
+            return code, result
+    return SCRIPT_BUSY_CODE, result
+
+
+def _run_command_locked(extra_args, timeout_secs):
     cmd_args = ["sudo", "/usr/local/connectbox/bin/ConnectBoxManage.sh"]
-    called_cmd = subprocess.run(cmd_args + extra_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    start = time.perf_counter()
+    called_cmd = subprocess.Popen(cmd_args + extra_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        stdout, stderr = called_cmd.communicate(timeout=timeout_secs)
+    except subprocess.TimeoutExpired:
+        # sudo passes SIGTERM on to the script, but can't pass on SIGKILL
+        called_cmd.terminate()
+        try:
+            called_cmd.communicate(timeout=COMMAND_KILL_GRACE_SECS)
+        except subprocess.TimeoutExpired:
+            called_cmd.kill()
+            called_cmd.communicate()
+        return TIMED_OUT_CODE, ["Timed out after %d seconds" % timeout_secs]
+    finally:
+        metrics.add_subprocess_time(extra_args[0], time.perf_counter() - start)
 
-    result_string= called_cmd.stdout
+    result_string= stdout
     if called_cmd.returncode != 0:
-        result_string= called_cmd.stderr
+        result_string= stderr
+
+    return called_cmd.returncode, result_string.decode("utf-8").rstrip().split("\n")
+
+
+def _call_command(extra_args):
+    code, result = _run_command(extra_args,
+                                _settings()["command_timeout_secs"])
+    return json_response({'code': code, 'result': result})
+
+
+def invalidate_property_cache(prop=None):
+    """Forget the cached value of prop, or of everything"""
+    config_reader.invalidate(prop)
+
 
-    return jsonify(code=called_cmd.returncode,
-           result=result_string.decode("utf-8").rstrip().split("\n"))
+def get_properties(props):
+    """Read props, returning (code, {prop: result lines})
+
+    Properties are read from their configuration files (or the cache of
+    them) by config_reader. Any whose files can't be read are read with
+    a single call of the manage script instead. If that call fails, its
+    code and output are returned.
+    """
+    results = {}
+    misses = {}
+    for prop in props:
+        try:
+            results[prop] = [config_reader.read_property(prop)]
+        except OSError:
+            signature = config_reader.sources_signature(prop)
+            value = config_reader.cached_value(prop, signature)
+            if value is None:
+                # Taken before reading, so a change made while the script
+                #  runs is noticed next time
+                misses[prop] = signature
+            else:
+                results[prop] = [value]
+    if not misses:
+        return 0, results
+
+    code, lines = _run_command(["getmany"] + sorted(misses),
+                               _settings()["command_timeout_secs"])
+    values = dict(line.split("=", 1) for line in lines if "=" in line)
+    if code != 0 or any(prop not in values for prop in misses):
+        # e.g. the script was already running, and printed why instead
+        return code or 1, lines
+    for prop, signature in misses.items():
+        results[prop] = [values[prop]]
+        config_reader.store(prop, signature, values[prop])
+    return 0, results
+
+
+def _write_property(prop, value, timeout_secs):
+    """Run by the job thread to set prop"""
+    code, result = _run_command(["set", prop, value], timeout_secs)
+    invalidate_property_cache(prop)
+    if code == 0:
+        _notify_property_changed(prop)
+    return code, result
+
+
+def _call_set_command(prop, value):
+    """Set prop in the background
+
+    Clients that send "Prefer: respond-async" get a 202 with the job id
+    straight away, and can follow the job at jobs/<id>. Others wait for
+    the job and get its result, as before.
+    """
+    job = _settings()["jobs"].submit(prop, value)
+    if "respond-async" in request.headers.get("Prefer", ""):
+        return json_response({'code': 0, 'result': {'job': job.id}},
+                             status=202,
+                             headers={'Location': 'jobs/%s' % (job.id,)})
+    job.done.wait()
+    return json_response({'code': job.code, 'result': job.result})
+
+
+def get_job(job_id):
+    """State of a background write: status is queued, running, done or lost
+
+    Once done, code and result are those the write would have returned.
+    Unknown jobs get a plain 404, not the app's catch-all 404 page.
+    """
+    state = _settings()["jobs"].get(job_id)
+    if state is None:
+        abort(make_response("NOT FOUND", 404))
+    return json_response({'code': 0, 'result': state})
 
 
 def get_property(prop):
     prop_string = prop
     if prop_string not in valid_properties:
         _abort_bad_request()
-    return _call_command(["get", prop_string])
+    if prop_string not in config_reader.PROPERTY_SOURCES:
+        return _call_command(["get", prop_string])
+    code, result = get_properties([prop_string])
+    if code == 0:
+        result = result[prop_string]
+    return json_response({'code': code, 'result': result})
+
+
+def get_property_batch():
+    """Read several properties at once, e.g. ?props=ssid,channel"""
+    props = request.args.get("props", "").split(",")
+    if not all(prop in config_reader.PROPERTY_SOURCES for prop in props):
+        _abort_bad_request()
+    code, result = get_properties(props)
+    return json_response({'code': code, 'result': result})
 
 
 def set_property_value_wrapped(prop):
@@ -33,7 +196,7 @@ def set_property_value_wrapped(prop):
     possible_json = request.get_json(force=True, silent=True)
     if (not possible_json) or ("value" not in possible_json):
         _abort_bad_request() # bad request
-    return _call_command(["set", prop_string, possible_json["value"].encode("utf-8")])
+    return _call_set_command(prop_string, possible_json["value"].encode("utf-8"))
 
 def set_property(prop):
     prop_string = prop
@@ -43,7 +206,7 @@ def set_property(prop):
     if not string_data:
         _abort_bad_request() # bad request
 
-    return _call_command(["set", prop_string, string_data.encode("utf-8")])
+    return _call_set_command(prop_string, string_data.encode("utf-8"))
 
 
 def set_system_property():
@@ -53,12 +216,29 @@ def set_system_property():
     if request.json["value"] in ["shutdown", "reboot"]:
         # Safe as input is limited
         subprocess.Popen("sleep 1; " + request.json["value"], shell=True)
-        return jsonify(code=0, result="SUCCESS")
+        return json_response({'code': 0, 'result': "SUCCESS"})
 
+    # e.g. reset puts every property back to its original value
+    invalidate_property_cache()
     return _call_command([request.json["value"]])
 
 
-def register(app):
+def register(app, command_timeout_secs=COMMAND_TIMEOUT_SECS):
+    app.extensions[EXTENSION_KEY] = {
+        'command_timeout_secs': command_timeout_secs,
+        'jobs': JobRunner(functools.partial(
+            _write_property, timeout_secs=command_timeout_secs)),
+    }
+    app.add_url_rule(
+        rule='/admin/api/jobs/<job_id>',
+        endpoint='get_job',
+        methods=['GET'],
+        view_func=get_job)
+    app.add_url_rule(
+        rule='/admin/api',
+        endpoint='get_property_batch',
+        methods=['GET'],
+        view_func=get_property_batch)
     app.add_url_rule(
         rule='/admin/api/<prop>',
         endpoint='get_property',
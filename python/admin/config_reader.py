@@ -0,0 +1,134 @@
+"""
+Read-only access to the properties ConnectBoxManage.sh can "get"
+
+The script's get functions only parse a few configuration files, so
+they are reproduced here (including the script's quirks, e.g. runs of
+whitespace being collapsed by its unquoted echo) to answer reads without
+running it through sudo. Values are cached until one of the files they
+come from changes. Anything that can't be read raises OSError, and the
+caller falls back to the script.
+"""
+
+import errno
+import os
+import socket
+import threading
+
+HOSTAPD_CONFIG = "/etc/hostapd/hostapd.conf"
+HOSTNAME_CONFIG = "/etc/hostname"
+INTERFACE_SYMLINK = "/etc/nginx/sites-enabled/connectbox_interface.conf"
+UI_CONFIG = "/var/www/connectbox/connectbox_default/config/default.json"
+
+# The files each property is read from. A cached value is used until one
+#  of them changes
+PROPERTY_SOURCES = {
+    "ssid": [HOSTAPD_CONFIG],
+    "channel": [HOSTAPD_CONFIG],
+    "hostname": [HOSTNAME_CONFIG],
+    "staticsite": [INTERFACE_SYMLINK],
+    "ui-config": [UI_CONFIG],
+}
+# prop -> (signature of its source files, value)
+_cache = {}
+_cache_lock = threading.Lock()
+# [hits, misses] of the cache, as counted by cached_value
+_cache_stats = [0, 0]
+
+
+def _echo(text):
+    """What the script's unquoted echo makes of text"""
+    return " ".join(text.split())
+
+
+def _hostapd_value(key):
+    # grep '^key=' | cut -d"=" -f2
+    with open(HOSTAPD_CONFIG) as config:
+        return _echo(" ".join(line.split("=")[1] for line in config
+                              if line.startswith(key + "=")))
+
+
+def _read_hostname():
+    return socket.gethostname()
+
+
+def _read_staticsite():
+    try:
+        target = os.readlink(INTERFACE_SYMLINK)
+    except OSError as error:
+        # readlink prints nothing for a missing file or a non-symlink
+        if error.errno in (errno.ENOENT, errno.EINVAL):
+            return "false"
+        raise
+    return "true" if target.endswith("connectbox_static-site.conf") \
+        else "false"
+
+
+def _read_ui_config():
+    with open(UI_CONFIG) as config:
+        return _echo(config.read())
+
+
+READERS = {
+    "ssid": lambda: _hostapd_value("ssid"),
+    "channel": lambda: _hostapd_value("channel"),
+    "hostname": _read_hostname,
+    "staticsite": _read_staticsite,
+    "ui-config": _read_ui_config,
+}
+
+
+def sources_signature(prop):
+    """Identifies the current version of the files prop is read from"""
+    signature = []
+    for path in PROPERTY_SOURCES[prop]:
+        try:
+            # lstat, so that re-pointing a symlink counts as a change
+            stat = os.lstat(path)
+            signature.append((stat.st_ino, stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            signature.append(None)
+    return tuple(signature)
+
+
+def cached_value(prop, signature):
+    """The value cached for prop if it was read at signature, or None"""
+    entry = _cache.get(prop)
+    if entry is None or entry[0] != signature:
+        _cache_stats[1] += 1
+        return None
+    _cache_stats[0] += 1
+    return entry[1]
+
+
+def cache_info():
+    """(hits, misses) of the property cache in this process"""
+    return tuple(_cache_stats)
+
+
+def store(prop, signature, value):
+    """Cache value, read for prop when its files were at signature"""
+    with _cache_lock:
+        _cache[prop] = (signature, value)
+
+
+def invalidate(prop=None):
+    """Forget the cached value of prop, or of everything"""
+    with _cache_lock:
+        if prop is None:
+            _cache.clear()
+        else:
+            _cache.pop(prop, None)
+
+
+def read_property(prop):
+    """The value of prop, as ConnectBoxManage.sh get would print it
+
+    Raises OSError if its files can't be read.
+    """
+    # Taken before reading, so a change made meanwhile is noticed next time
+    signature = sources_signature(prop)
+    value = cached_value(prop, signature)
+    if value is None:
+        value = READERS[prop]()
+        store(prop, signature, value)
+    return value
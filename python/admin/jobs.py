@@ -0,0 +1,173 @@
+"""
+Background execution of admin write commands
+
+Setting a property can restart hostapd or reload nginx, which takes
+seconds. Writes are queued as jobs and run one at a time by a thread in
+the worker that received them, so the request can be answered straight
+away with the job's id. A write to a property that already has a job
+waiting to start is folded into that job, as only the last value
+matters.
+
+The manage script refuses to run while another copy is running, so
+every run of it, by a job or a request in any worker, holds
+script_lock(). Each job's state is kept in a file in JOBS_DIRECTORY,
+because the request asking about it may arrive at a different worker.
+"""
+
+import atexit
+import contextlib
+import fcntl
+import json
+import os
+import threading
+import time
+import uuid
+
+JOBS_DIRECTORY = "/tmp/connectbox-admin-jobs"
+# Finished jobs are forgotten after this long
+JOB_RETENTION_SECS = 3600
+
+
+@contextlib.contextmanager
+def script_lock(jobs_dir=JOBS_DIRECTORY):
+    """Hold the lock that serialises runs of the manage script"""
+    os.makedirs(jobs_dir, exist_ok=True)
+    with open(os.path.join(jobs_dir, "lock"), "w") as lock_file:
+        # Taken on a file opened here, so that threads of the same worker
+        #  exclude each other too
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+class Job(object):
+    """A write of value to prop"""
+
+    def __init__(self, prop, value):
+        self.id = uuid.uuid4().hex
+        self.prop = prop
+        self.value = value
+        self.status = "queued"
+        self.code = None
+        self.result = None
+        self.done = threading.Event()
+
+    def as_dict(self):
+        """The job's state. Leaves out the value, which may be a password"""
+        return {
+            "id": self.id,
+            "prop": self.prop,
+            "status": self.status,
+            "code": self.code,
+            "result": self.result,
+            "pid": os.getpid(),
+        }
+
+
+class JobRunner(object):
+    """Runs jobs one at a time in a background thread"""
+
+    def __init__(self, run_fn, jobs_dir=JOBS_DIRECTORY):
+        """run_fn(prop, value) performs a write, returning (code, result)"""
+        self._run_fn = run_fn
+        self._jobs_dir = jobs_dir
+        self._condition = threading.Condition()
+        self._queue = []
+        self._current = None
+        self._thread = None
+        self._thread_pid = None
+
+    def _path(self, job_id):
+        return os.path.join(self._jobs_dir, "%s.json" % (job_id,))
+
+    def _save(self, job):
+        path = self._path(job.id)
+        with open(path + ".tmp", "w") as job_file:
+            json.dump(job.as_dict(), job_file)
+        os.rename(path + ".tmp", path)
+
+    def _prune(self):
+        oldest_allowed = time.time() - JOB_RETENTION_SECS
+        for name in os.listdir(self._jobs_dir):
+            path = os.path.join(self._jobs_dir, name)
+            try:
+                if name.endswith(".json") and \
+                        os.stat(path).st_mtime < oldest_allowed:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def _ensure_thread(self):
+        """Start the job thread in this process. Caller holds lock"""
+        if self._thread_pid != os.getpid():
+            self._queue = []
+            self._current = None
+            self._thread = threading.Thread(target=self._run_jobs,
+                                            name="admin-jobs")
+            self._thread.daemon = True
+            self._thread.start()
+            self._thread_pid = os.getpid()
+            atexit.register(self.wait_for_current)
+
+    def submit(self, prop, value):
+        """Queue a write of value to prop, returning its Job"""
+        with self._condition:
+            for job in self._queue:
+                if job.prop == prop:
+                    job.value = value
+                    return job
+            if not os.path.isdir(self._jobs_dir):
+                os.makedirs(self._jobs_dir)
+            self._prune()
+            job = Job(prop, value)
+            self._save(job)
+            self._ensure_thread()
+            self._queue.append(job)
+            self._condition.notify_all()
+            return job
+
+    def _run_job(self, job):
+        try:
+            return self._run_fn(job.prop, job.value)
+        except Exception as error:  # pylint: disable=broad-except
+            return 1, [str(error)]
+
+    def _run_jobs(self):
+        while True:
+            with self._condition:
+                while not self._queue:
+                    self._condition.wait()
+                job = self._current = self._queue.pop(0)
+                job.status = "running"
+            self._save(job)
+            job.code, job.result = self._run_job(job)
+            job.status = "done"
+            self._save(job)
+            with self._condition:
+                self._current = None
+                self._condition.notify_all()
+            job.done.set()
+
+    def wait_for_current(self):
+        """Let a job that has started finish, e.g. before the worker exits"""
+        with self._condition:
+            while self._current is not None:
+                self._condition.wait()
+
+    def get(self, job_id):
+        """The state of a job run by any worker, or None if unknown"""
+        if not job_id or not all(c in "0123456789abcdef" for c in job_id):
+            return None
+        try:
+            with open(self._path(job_id)) as job_file:
+                state = json.load(job_file)
+        except (OSError, ValueError):
+            return None
+        if state["status"] != "done":
+            try:
+                os.kill(state["pid"], 0)
+            except ProcessLookupError:
+                # The worker running it has gone, e.g. killed by gunicorn
+                state["status"] = "lost"
+            except OSError:
+                pass
+        return state
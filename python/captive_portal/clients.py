@@ -0,0 +1,166 @@
+"""
+Registries of clients that have recently passed through the captive portal
+
+Clients are keyed on their IP address. IPv4 addresses are packed into
+ints to keep entries small; anything else (e.g. IPv6 or a multi-hop
+X-Forwarded-For value) is stored as given. Entries expire once they are
+older than the DHCP lease time, and each registry holds at most
+max_entries clients, dropping the least recently seen when full.
+
+MemoryClientRegistry is private to a process. SQLiteClientRegistry keeps
+its table in a WAL-mode SQLite database, so all gunicorn workers share it.
+"""
+
+import collections
+import os
+import socket
+import sqlite3
+import struct
+import threading
+import time
+
+DEFAULT_MAX_ENTRIES = 4096
+# How many registrations the SQLite registry accepts between purges
+SQLITE_PURGE_INTERVAL = 64
+SQLITE_BUSY_TIMEOUT_SECS = 5
+
+
+def pack_ip(ip_addr_str):
+    """Pack a dotted-quad IPv4 address into an int, otherwise return it"""
+    try:
+        return struct.unpack("!I", socket.inet_aton(ip_addr_str))[0]
+    except (OSError, TypeError):
+        return ip_addr_str
+
+
+class MemoryClientRegistry(object):
+    """In-process registry. Not shared between gunicorn workers"""
+
+    def __init__(self, max_age_secs, max_entries=DEFAULT_MAX_ENTRIES):
+        """max_age_secs is called to get the current expiry age"""
+        self._max_age_secs = max_age_secs
+        self._max_entries = max_entries
+        # Re-registration moves a client to the end, so the first entry is
+        #  always the least recently seen. An OrderedDict, as plain dicts
+        #  don't keep their order on the Python 3.5 of our targets
+        self._last_seen = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._last_seen)
+
+    def _purge(self, now):
+        """Drop expired entries, then the oldest entries if over capacity"""
+        oldest_allowed = now - self._max_age_secs()
+        while self._last_seen:
+            oldest_key = next(iter(self._last_seen))
+            if self._last_seen[oldest_key] >= oldest_allowed and \
+                    len(self._last_seen) <= self._max_entries:
+                break
+            self._last_seen.popitem(last=False)
+
+    def register(self, ip_addr_str):
+        key = pack_ip(ip_addr_str)
+        now = int(time.time())
+        with self._lock:
+            self._last_seen[key] = now
+            self._last_seen.move_to_end(key)
+            self._purge(now)
+
+    def is_recent(self, ip_addr_str):
+        last_seen = self._last_seen.get(pack_ip(ip_addr_str))
+        if last_seen is None:
+            return False
+        return time.time() - last_seen < self._max_age_secs()
+
+    def forget(self, ip_addr_str):
+        with self._lock:
+            self._last_seen.pop(pack_ip(ip_addr_str), None)
+
+
+class SQLiteClientRegistry(object):
+    """Registry stored in SQLite so that it is shared between processes"""
+
+    def __init__(self, db_path, max_age_secs,
+                 max_entries=DEFAULT_MAX_ENTRIES):
+        """max_age_secs is called to get the current expiry age"""
+        self._db_path = db_path
+        self._max_age_secs = max_age_secs
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = None
+        self._conn_pid = None
+        self._registrations_since_purge = 0
+
+    def _connection(self):
+        """Connection for this process, opened after any fork"""
+        if self._conn_pid != os.getpid():
+            conn = sqlite3.connect(self._db_path,
+                                   timeout=SQLITE_BUSY_TIMEOUT_SECS,
+                                   isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # Losing the last few registrations on power loss only means
+            #  a client sees the welcome page again, so skip the fsyncs
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS clients"
+                " (ip PRIMARY KEY, last_seen INTEGER NOT NULL)"
+                " WITHOUT ROWID")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS clients_last_seen_idx"
+                " ON clients (last_seen)")
+            self._conn = conn
+            self._conn_pid = os.getpid()
+        return self._conn
+
+    def __len__(self):
+        with self._lock:
+            return self._connection().execute(
+                "SELECT count(*) FROM clients").fetchone()[0]
+
+    def _purge(self, conn, now):
+        """Drop expired entries, then the oldest entries if over capacity"""
+        conn.execute("DELETE FROM clients WHERE last_seen < ?",
+                     (now - self._max_age_secs(),))
+        conn.execute(
+            "DELETE FROM clients WHERE ip IN (SELECT ip FROM clients"
+            " ORDER BY last_seen LIMIT"
+            " max(0, (SELECT count(*) FROM clients) - ?))",
+            (self._max_entries,))
+
+    def register(self, ip_addr_str):
+        now = int(time.time())
+        with self._lock:
+            conn = self._connection()
+            conn.execute(
+                "INSERT OR REPLACE INTO clients (ip, last_seen)"
+                " VALUES (?, ?)", (pack_ip(ip_addr_str), now))
+            self._registrations_since_purge += 1
+            if self._registrations_since_purge >= SQLITE_PURGE_INTERVAL:
+                self._registrations_since_purge = 0
+                self._purge(conn, now)
+
+    def is_recent(self, ip_addr_str):
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT last_seen FROM clients WHERE ip = ?",
+                (pack_ip(ip_addr_str),)).fetchone()
+        if row is None:
+            return False
+        return time.time() - row[0] < self._max_age_secs()
+
+    def forget(self, ip_addr_str):
+        with self._lock:
+            self._connection().execute(
+                "DELETE FROM clients WHERE ip = ?", (pack_ip(ip_addr_str),))
+
+
+def create_registry(backend, max_age_secs, max_entries=DEFAULT_MAX_ENTRIES,
+                    db_path=None):
+    """Build a registry from its configuration name (memory or sqlite)"""
+    if backend == "memory":
+        return MemoryClientRegistry(max_age_secs, max_entries)
+    if backend == "sqlite":
+        return SQLiteClientRegistry(db_path, max_age_secs, max_entries)
+    raise ValueError("Unknown client registry backend: %s" % (backend,))
@@ -14,13 +14,19 @@ Does the minimum required to:
   and audio players and PDF viewing).
 """
 
-import datetime
+import functools
+import hashlib
+import http.client
 import os.path
-import requests
+import socket
+import threading
+import time
+import urllib.parse
 from flask import Flask, redirect, render_template, request, Response
-from ua_parser import user_agent_parser
 from werkzeug.contrib.fixers import ProxyFix
 
+from captive_portal.clients import MemoryClientRegistry
+
 LINK_OPS = {
     "TEXT": "text",
     "HREF": "href",
@@ -31,10 +37,31 @@ LINK_OPS = {
     "JS_HREF_NORMAL_CLICK": "javascript_href_normal_click",
     "JS_HREF_BLANK_CLICK": "javascript_href_blank_click",
 }
-_client_map = {}
+# Substrings of the user agents sent by OS captive portal probes. None of
+#  these can open links in the browser, so we skip the full parse for them.
+#  Not every probe is caught: current Android probes send a desktop
+#  browser's user agent, and iOS opens the page in a browser
+CAPTIVE_PORTAL_PROBE_UA_MARKERS = ("wispr", "CaptiveNetworkSupport", "Dalvik",
+                                   "Microsoft NCSI")
+LINK_TYPE_CACHE_SIZE = 256
 DHCP_FALLBACK_LEASE_SECS = 86400  # 1 day
+DHCP_LEASE_TIME_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+DNSMASQ_CONF_FILE = "/etc/dnsmasq.conf"
+# (file signature, parsed config) for the last parse of DNSMASQ_CONF_FILE
+_dnsmasq_config_snapshot = (None, None)
 REAL_HOST_REDIRECT_URL = "http://127.0.0.1/to-hostname"
-_real_connectbox_url = None
+REAL_HOST_REDIRECT_TIMEOUT_SECS = 2
+# How long to use the hostname-derived URL before asking nginx again. Also
+#  how long after a hostname change nginx's answer is only used for, as
+#  nginx may not have been reloaded with the new name yet
+REAL_HOST_RETRY_SECS = 30
+HOSTNAME_FILE = "/etc/hostname"
+# (url, expiry, HOSTNAME_FILE signature) of the last lookup. An expiry of
+#  None means the URL is good until the hostname changes
+_real_connectbox_url_snapshot = (None, None, None)
+_real_connectbox_url_lock = threading.Lock()
+# (template, link_type, connectbox_url) -> (body, etag)
+_rendered_response_cache = {}
 
 
 def redirect_to_connectbox():
@@ -42,7 +69,33 @@ def redirect_to_connectbox():
     #  authorise because it'll interfere with the client-specific
     #  authorisation workflow. We assume that the client-specific
     #  workflow will be done separately.
-    return redirect(_real_connectbox_url)
+    return redirect(get_real_connectbox_url())
+
+
+def _lookup_real_connectbox_url():
+    """Ask nginx where the connectbox can be found
+
+    Returns the URL and how long it can be used for (None meaning until
+    it is refreshed). If nginx doesn't answer promptly we build the URL
+    from our hostname, as that's what the nginx redirect uses, but we'll
+    ask again later in case nginx has been configured differently.
+
+    This runs when a worker starts, so it uses http.client, which Flask
+    has already imported, rather than the slow to import requests.
+    """
+    url = urllib.parse.urlsplit(REAL_HOST_REDIRECT_URL)
+    conn = http.client.HTTPConnection(
+        url.hostname, url.port, timeout=REAL_HOST_REDIRECT_TIMEOUT_SECS)
+    try:
+        conn.request("GET", url.path + ("?" + url.query if url.query else ""))
+        location = conn.getresponse().getheader("Location")
+    except (OSError, http.client.HTTPException):
+        location = None
+    finally:
+        conn.close()
+    if location:
+        return location, None
+    return "http://%s" % (socket.gethostname(),), REAL_HOST_RETRY_SECS
 
 
 def get_real_connectbox_url():
@@ -52,30 +105,175 @@ def get_real_connectbox_url():
     the default vhost to the connectbox host but that would mean putting
     an ugly URL like http://a.b.c.d/some-redirect in the captive portal
     page. So we use the value from that redirect to present a nice URL.
-    """
-    global _real_connectbox_url
-    if not _real_connectbox_url:
-        resp = requests.get(REAL_HOST_REDIRECT_URL,
-                            allow_redirects=False)
-        _real_connectbox_url = resp.headers["Location"]
-    return _real_connectbox_url
-
 
-def get_dhcp_lease_secs():
-    """Extract lease time from /etc/dnsmasq.conf
+    The URL is normally resolved when the app starts, and again when
+    HOSTNAME_FILE changes. A hostname change is made by one worker, so
+    each worker checks the file's signature rather than waiting to be
+    told. Requests that arrive while a lookup is underway wait for that
+    lookup instead of making their own.
+    """
+    signature = _hostname_signature()
+    url = _usable_real_connectbox_url(signature)
+    if url:
+        return url
+    with _real_connectbox_url_lock:
+        # Another request may have completed the lookup while we waited
+        url = _usable_real_connectbox_url(signature)
+        if url:
+            return url
+        return _refresh_real_connectbox_url_locked(signature)
+
+
+def _hostname_signature():
+    try:
+        stat_result = os.stat(HOSTNAME_FILE)
+        return (stat_result.st_ino, stat_result.st_mtime,
+                stat_result.st_size)
+    except OSError:
+        return None
+
+
+def _usable_real_connectbox_url(signature):
+    """The cached URL, or None if it has expired or the hostname changed"""
+    url, expiry, cached_signature = _real_connectbox_url_snapshot
+    if url and cached_signature == signature and \
+            (expiry is None or expiry > time.time()):
+        return url
+    return None
+
+
+def _refresh_real_connectbox_url_locked(signature):
+    """Look the URL up, noting the HOSTNAME_FILE signature it goes with
+
+    The signature must be taken before the lookup, so that a change
+    during the lookup is noticed on the next request.
+    """
+    global _real_connectbox_url_snapshot
+    url, ttl = _lookup_real_connectbox_url()
+    if ttl is None and signature is not None and \
+            time.time() - signature[1] < REAL_HOST_RETRY_SECS:
+        # The hostname has just changed. Ask again in case nginx answered
+        #  before it was reloaded
+        ttl = REAL_HOST_RETRY_SECS
+    expiry = None if ttl is None else time.time() + ttl
+    if url != _real_connectbox_url_snapshot[0]:
+        # Pages for the old URL won't be asked for again
+        _rendered_response_cache.clear()
+    _real_connectbox_url_snapshot = (url, expiry, signature)
+    return url
+
+
+def refresh_real_connectbox_url():
+    """Look up the connectbox URL again e.g. after a hostname change"""
+    with _real_connectbox_url_lock:
+        return _refresh_real_connectbox_url_locked(_hostname_signature())
+
+
+def render_cached_response(template, link_type=None, connectbox_url=None):
+    """Response for a captive portal template, rendered once per variant
+
+    Our templates only vary by link type and connectbox URL, which have a
+    handful of values between them, so probe storms can be answered with
+    bodies rendered (and ETags hashed) on first use. Pages are keyed on the
+    URL, which get_real_connectbox_url() keeps current in every worker, so
+    a hostname change gives them new bodies and ETags.
+    """
+    key = (template, link_type, connectbox_url)
+    cached = _rendered_response_cache.get(key)
+    if cached is None:
+        body = render_template(template,
+                               connectbox_url=connectbox_url,
+                               LINK_OPS=LINK_OPS,
+                               link_type=link_type).encode("utf-8")
+        cached = (body, hashlib.sha1(body).hexdigest())
+        _rendered_response_cache[key] = cached
+    body, etag = cached
+    response = Response(body, mimetype="text/html")
+    response.set_etag(etag)
+    return response
+
+
+def _parse_dhcp_lease_secs(lease_time_str):
+    """Convert a dnsmasq lease time (e.g. 300, 45m, 12h, infinite) to secs"""
+    lease_time_str = lease_time_str.strip().lower()
+    if lease_time_str == "infinite":
+        return None
+    multiplier = DHCP_LEASE_TIME_UNITS.get(lease_time_str[-1:])
+    if multiplier:
+        return int(lease_time_str[:-1]) * multiplier
+    return int(lease_time_str)
+
+
+def _parse_dnsmasq_conf(dnsmasq_file):
+    """Extract the dhcp-range and lease time from a dnsmasq config file
 
     dhcp-range=10.129.0.2,10.129.0.250,255.255.255.0,300
     """
+    dhcp_range = None
     # So we have a valid lease time if we can't parse the file for
     #  some reason (this shouldn't ever be necessary)
-    _dhcp_lease_secs = DHCP_FALLBACK_LEASE_SECS
-    dnsmasq_file = "/etc/dnsmasq.conf"
-    if os.path.isfile(dnsmasq_file):
-        with open(dnsmasq_file) as dnsmasq_conf:
-            for line in dnsmasq_conf:
-                if line[:10] == "dhcp_range":
-                    _dhcp_lease_secs = int(line.split(",")[-1])
-    return _dhcp_lease_secs
+    dhcp_lease_secs = DHCP_FALLBACK_LEASE_SECS
+    with open(dnsmasq_file) as dnsmasq_conf:
+        for line in dnsmasq_conf:
+            key, _, value = line.strip().partition("=")
+            if key.strip() != "dhcp-range":
+                continue
+            fields = [field.strip() for field in value.split(",")]
+            dhcp_range = tuple(fields[:2])
+            try:
+                dhcp_lease_secs = \
+                    _parse_dhcp_lease_secs(fields[-1]) or \
+                    DHCP_FALLBACK_LEASE_SECS
+            except ValueError:
+                # No lease time given (dnsmasq defaults to 1 hour) or it's
+                #  in a form we don't understand
+                dhcp_lease_secs = DHCP_FALLBACK_LEASE_SECS
+    return {"dhcp_range": dhcp_range, "dhcp_lease_secs": dhcp_lease_secs}
+
+
+def get_dnsmasq_config():
+    """Return a snapshot of the values we use from /etc/dnsmasq.conf
+
+    This is called on each captive portal probe, so the file is only
+    re-parsed when its mtime or inode changes (i.e. when it is edited in
+    place or replaced). The snapshot is a dict with dhcp_range (a
+    (start, end) tuple, or None if not configured) and dhcp_lease_secs.
+    """
+    global _dnsmasq_config_snapshot
+    try:
+        stat_result = os.stat(DNSMASQ_CONF_FILE)
+        file_sig = (stat_result.st_ino, stat_result.st_mtime,
+                    stat_result.st_size)
+    except OSError:
+        file_sig = None
+
+    cached_sig, config = _dnsmasq_config_snapshot
+    if config is None or cached_sig != file_sig:
+        config = {"dhcp_range": None,
+                  "dhcp_lease_secs": DHCP_FALLBACK_LEASE_SECS}
+        if file_sig is not None:
+            try:
+                config = _parse_dnsmasq_conf(DNSMASQ_CONF_FILE)
+            except (IOError, OSError):
+                pass
+        # Swap in a new tuple so concurrent readers never see a config
+        #  paired with the wrong file signature
+        _dnsmasq_config_snapshot = (file_sig, config)
+    return config
+
+
+def get_dhcp_lease_secs():
+    """Lease time from /etc/dnsmasq.conf, cached until the file changes"""
+    return get_dnsmasq_config()["dhcp_lease_secs"]
+
+
+def get_dhcp_range():
+    """(start, end) dhcp-range from /etc/dnsmasq.conf, or None"""
+    return get_dnsmasq_config()["dhcp_range"]
+
+
+# Replaced by setup_captive_portal_app() if a shared registry is configured
+_client_registry = MemoryClientRegistry(get_dhcp_lease_secs)
 
 
 def is_recent_authorised_client(ip_addr_str):
@@ -89,16 +287,15 @@ def is_recent_authorised_client(ip_addr_str):
 
     We base our recency criteria on the DHCP lease time
     """
-    diff_client_recency_criteria = \
-        datetime.timedelta(seconds=get_dhcp_lease_secs())
-    last_registered_time = _client_map.get(ip_addr_str)
-    if last_registered_time:
-        time_since_reg = datetime.datetime.now() - last_registered_time
-        return time_since_reg < diff_client_recency_criteria
-    return False
+    return _client_registry.is_recent(ip_addr_str)
 
 
-def get_link_type(ua_str):
+def _classify_user_agent(ua_str):
+    """Uncached mapping of a user agent string to one of LINK_OPS"""
+    # Importing compiles hundreds of regexes, which takes seconds on a Pi
+    #  Zero. Probes with CAPTIVE_PORTAL_PROBE_UA_MARKERS don't get this far,
+    #  but others do, so warm_up() imports it soon after the worker starts
+    from ua_parser import user_agent_parser
     user_agent = user_agent_parser.Parse(ua_str)
     if user_agent["os"]["family"] == "iOS" and \
             user_agent["os"]["major"] == "9":
@@ -122,6 +319,37 @@ def get_link_type(ua_str):
     return LINK_OPS["TEXT"]
 
 
+_cached_classify_user_agent = \
+    functools.lru_cache(maxsize=LINK_TYPE_CACHE_SIZE)(_classify_user_agent)
+
+
+def configure_link_type_cache(maxsize):
+    """(Re)create the user agent classification cache with a new size
+
+    Any existing entries and hit/miss counts are discarded.
+    """
+    global _cached_classify_user_agent
+    _cached_classify_user_agent = \
+        functools.lru_cache(maxsize=maxsize)(_classify_user_agent)
+
+
+def link_type_cache_info():
+    """Hits, misses, maxsize and currsize of the link type cache"""
+    return _cached_classify_user_agent.cache_info()
+
+
+def get_link_type(ua_str):
+    """Decide how to present the ConnectBox URL to this user agent
+
+    The same few dozen user agents make nearly all requests, so decisions
+    are memoised on the raw user agent string in a bounded LRU cache.
+    """
+    for marker in CAPTIVE_PORTAL_PROBE_UA_MARKERS:
+        if marker in ua_str:
+            return LINK_OPS["TEXT"]
+    return _cached_classify_user_agent(ua_str)
+
+
 def add_authorised_client(ip_addr_str=None):
     if ip_addr_str is None:
         ip_addr_str = request.headers["X-Forwarded-For"]
@@ -131,7 +359,7 @@ def add_authorised_client(ip_addr_str=None):
 
 
 def register_client(ip_addr_str):
-    _client_map[ip_addr_str] = datetime.datetime.now()
+    _client_registry.register(ip_addr_str)
 
 
 def welcome_or_serve_template(template):
@@ -139,7 +367,7 @@ def welcome_or_serve_template(template):
     if is_recent_authorised_client(source_ip):
         # Update last-seen time
         register_client(source_ip)
-        return render_template(template)
+        return render_cached_response(template)
 
     return add_authorised_client()
 
@@ -173,23 +401,38 @@ def cp_check_ios_gte_v9_macos_gte_v1010():
 def remove_authorised_client(ip_addr_str=None):
     """Forgets that a client has been seen recently to allow running tests"""
     source_ip = request.headers["X-Forwarded-For"]
-    if source_ip in _client_map:
-        del _client_map[source_ip]
+    _client_registry.forget(source_ip)
 
     return Response(status=204)
 
 
 def show_captive_portal_welcome():
     ua_str = request.headers.get("User-agent", "")
-    return render_template(
+    return render_cached_response(
         "connected.html",
-        connectbox_url=get_real_connectbox_url(),
-        LINK_OPS=LINK_OPS,
         link_type=get_link_type(ua_str),
+        connectbox_url=get_real_connectbox_url(),
     )
 
 
-def setup_captive_portal_app(cpm):
+def warm_up():
+    """Import what the first browser (rather than probe) request needs"""
+    from ua_parser import user_agent_parser  # noqa: F401
+
+
+def setup_captive_portal_app(cpm, link_type_cache_size=LINK_TYPE_CACHE_SIZE,
+                             client_registry=None):
+    """Register the captive portal routes
+
+    client_registry replaces the default in-process registry of recently
+    authorised clients (see captive_portal.clients) and must be shared
+    when running more than one worker process.
+    """
+    global _client_registry
+    if link_type_cache_size != LINK_TYPE_CACHE_SIZE:
+        configure_link_type_cache(link_type_cache_size)
+    if client_registry is not None:
+        _client_registry = client_registry
     cpm.add_url_rule('/success.html',
                      'success',
                      cp_check_ios_lt_v9_macos_lt_v1010)
@@ -228,5 +471,9 @@ def setup_captive_portal_app(cpm):
     cpm.add_url_rule('/_redirect_to_connectbox',
                      'redirect', redirect_to_connectbox)
     cpm.wsgi_app = ProxyFix(cpm.wsgi_app)
-
-_dhcp_lease_secs = get_dhcp_lease_secs()
+    # Parse dnsmasq.conf and find our URL before the first probe arrives.
+    #  nginx may not be up yet, so don't hold up startup waiting for it
+    get_dnsmasq_config()
+    threading.Thread(target=get_real_connectbox_url,
+                     name="connectbox-url-lookup",
+                     daemon=True).start()
@@ -1,110 +1,512 @@
 """ Database access module """
+import atexit
+import collections
+import functools
+import logging
+import os
+import re
+import threading
+import time
 import sqlalchemy
+from sqlalchemy import Column, DateTime, Integer, String, Table, Text, text
+from sqlalchemy.pool import QueuePool
+import metrics
+from chat.recent import RecentMessages
+from chat.stats import TextDirectionCounter
+from chat.writer import BatchWriter
 
-STATE = {}
-STATE['connected'] = False
+# Most messages removed by one transaction while expiring messages
+DELETE_BATCH_SIZE = 500
+# Pragmas that may be set from the configuration file
+TUNABLE_PRAGMAS = ('journal_mode', 'synchronous', 'mmap_size', 'cache_size',
+                   'busy_timeout', 'temp_store')
+# How SQLite reports back the pragma values that can be given as names
+PRAGMA_VALUE_NAMES = {
+    'synchronous': {0: 'off', 1: 'normal', 2: 'full', 3: 'extra'},
+    'temp_store': {0: 'default', 1: 'file', 2: 'memory'},
+}
+# Pooled connections per worker process. Should be at least the number of
+#  threads serving requests in each worker
+DEFAULT_POOL_SIZE = 4
+# When SQLite is still busy after busy_timeout (or reports busy without
+#  waiting, which it does to avoid deadlocks in WAL mode), retry with
+#  exponential backoff for up to this long
+BUSY_RETRY_FIRST_DELAY_SECS = 0.01
+BUSY_RETRY_MAX_DELAY_SECS = 0.5
+BUSY_RETRY_MAX_SECS = 10
+# Longest time cached_generation() goes without checking the database.
+#  Changes made through this worker are seen straight away
+GENERATION_CHECK_SECS = 1.0
+# Compiled forms of the statements below, kept per engine
+COMPILED_CACHE_SIZE = 64
+LOGGER = logging.getLogger(__name__)
+
+# A message as read from the database: the columns of SELECT_MESSAGES
+Message = collections.namedtuple(
+    'Message', ['id', 'timestamp', 'nick', 'body', 'textDirection'])
+
+# The schema, as created (and migrated) by setup(). Defined here rather
+#  than reflected so that startup doesn't have to read it back
+METADATA = sqlalchemy.MetaData()
+MESSAGES = Table(
+    'messages', METADATA,
+    Column('timestamp', DateTime),
+    Column('nick', String(256)),
+    Column('message', Text),
+    Column('textDirection', String(3)),
+    Column('created', Integer))
+MESSAGE_STATS = Table(
+    'message_stats', METADATA,
+    Column('ltr', Integer),
+    Column('rtl', Integer))
+
+# The statements run by requests are built once, and the engine's compiled
+#  cache keeps their compiled forms, so each execution only binds values
+INSERT_MESSAGE = MESSAGES.insert()
+SELECT_MESSAGES = text(
+    'SELECT rowid, created, nick, message, textDirection FROM messages'
+    ' WHERE rowid > :since and rowid < :before_id'
+    ' order by rowid desc limit :limit offset :offset')
+COUNT_MESSAGES = text('select count(*) from messages')
+LATEST_MESSAGE_ID = text('select max(rowid) from messages')
+SELECT_GENERATION = text(
+    'select (select max(rowid) from messages), deletes'
+    ' from message_generation')
+DELETE_EXPIRED_BATCH = text(
+    'delete from messages where rowid in'
+    ' (select rowid from messages where created < :cutoff limit :limit)')
+BUMP_GENERATION = text('update message_generation set deletes = deletes + 1')
+ADD_TEXT_DIRECTION_STATS = text(
+    'update message_stats set ltr = ltr + :ltr, rtl = rtl + :rtl')
+SELECT_TEXT_DIRECTION_STATS = text('select ltr, rtl from message_stats')
+
+DATASOURCE = None
+
+class ChatDatasource(object):
+    """
+    The chat database's engine, connections and per-process caches
+
+    The engine (and its connection pool) is created on first use in each
+    process, so connections opened before gunicorn forks its workers are
+    never shared with them. Each thread (or greenlet, under gevent) gets
+    its own connection from the pool, which it keeps until release() is
+    called at the end of its request.
+    """
+
+    def __init__(self, conn_info, pragmas=(), pool_size=DEFAULT_POOL_SIZE):
+        _validate_pragmas(pragmas)
+        self.conn_info = conn_info
+        self.pragmas = tuple(pragmas)
+        self.pool_size = pool_size
+        self.recent = RecentMessages()
+        self.text_direction = TextDirectionCounter(
+            _flush_text_direction_stats)
+        # Set when inserts are batched by a write-behind queue
+        self.writer = None
+        self.write_behind_synchronous = None
+        # (time read, generation) from the last generation() call
+        self.generation_snapshot = None
+        self._engine = None
+        self._engine_pid = None
+        self._engine_lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def engine(self):
+        """ The engine for this process """
+        if self._engine_pid != os.getpid():
+            with self._engine_lock:
+                if self._engine_pid != os.getpid():
+                    # Anything inherited across a fork belongs to the parent,
+                    #  so drop it without closing it
+                    self._local = threading.local()
+                    engine = sqlalchemy.create_engine(
+                        self.conn_info,
+                        poolclass=QueuePool,
+                        pool_size=self.pool_size,
+                        max_overflow=self.pool_size,
+                        connect_args={'check_same_thread': False},
+                        execution_options={
+                            'compiled_cache':
+                                sqlalchemy.util.LRUCache(COMPILED_CACHE_SIZE)
+                        })
+                    sqlalchemy.event.listen(engine, 'connect',
+                                            _apply_pragmas(self.pragmas))
+                    if metrics.STORE is not None:
+                        sqlalchemy.event.listen(
+                            engine, 'before_cursor_execute',
+                            _start_statement_timer)
+                        sqlalchemy.event.listen(
+                            engine, 'after_cursor_execute',
+                            _record_statement_time)
+                    self._engine = engine
+                    self._engine_pid = os.getpid()
+        return self._engine
+
+    def connection(self):
+        """ This thread's connection, checked out of the pool if needed """
+        engine = self.engine
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or conn.closed:
+            conn = self._local.conn = engine.connect()
+        return conn
+
+    def release(self):
+        """ Return this thread's connection to the pool """
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            self._local.conn = None
+            conn.close()
+
+    def close(self):
+        """
+        Close all of this process's connections
+
+        A new engine is created if the datasource is used again.
+        """
+        if self._engine_pid == os.getpid():
+            self.release()
+            self._engine.dispose()
+        self._engine = None
+        self._engine_pid = None
+
+def _retry_when_busy(func):
+    """ Retry func with backoff while SQLite reports that it's busy """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        delay = BUSY_RETRY_FIRST_DELAY_SECS
+        deadline = time.time() + BUSY_RETRY_MAX_SECS
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except sqlalchemy.exc.OperationalError as error:
+                message = str(error.orig)
+                if ('database is locked' not in message and
+                        'database is busy' not in message) or \
+                        time.time() + delay > deadline:
+                    raise
+            # The connection may be left in a failed transaction
+            DATASOURCE.release()
+            time.sleep(delay)
+            delay = min(delay * 2, BUSY_RETRY_MAX_DELAY_SECS)
+    return wrapper
+
+def _conn():
+    return DATASOURCE.connection()
 
 def connected():
     """ Returns true if connected """
-    return STATE['connected']
+    return DATASOURCE is not None
+
+def _validate_pragmas(pragmas):
+    for name, value in pragmas:
+        if name not in TUNABLE_PRAGMAS or \
+                not re.match(r'^-?\w+$', str(value)):
+            raise ValueError('Unsupported pragma: %s = %s' % (name, value))
 
-def open_connection(conn_info):
-    """ Open database connection """
-    STATE['conn'] = sqlalchemy.create_engine(conn_info)
-    STATE['connected'] = True
+def _apply_pragmas(pragmas):
+    """ Returns a connect listener that applies the pragmas """
+    def on_connect(dbapi_connection, _):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas:
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+        cursor.close()
+    return on_connect
 
+def _start_statement_timer(conn, *_):
+    conn.info.setdefault('statement_starts', []).append(time.perf_counter())
+
+def _record_statement_time(conn, *_):
+    metrics.add_db_time(
+        time.perf_counter() - conn.info['statement_starts'].pop())
+
+def open_connection(conn_info, pragmas=(), pool_size=DEFAULT_POOL_SIZE):
+    """
+    Open database connection
+
+    pragmas is a sequence of (name, value) pairs from TUNABLE_PRAGMAS that
+    is applied to every connection the engine opens. Nothing is actually
+    opened until the database is first used.
+    """
+    global DATASOURCE
+    DATASOURCE = ChatDatasource(conn_info, pragmas, pool_size)
+
+def enable_write_behind(interval_secs, batch_size, synchronous=None):
+    """
+    Batch inserts through a write-behind queue
+
+    synchronous, if given, is the synchronous pragma used while committing
+    a batch, so that e.g. FULL can be used for posts without paying for
+    it on every other write.
+    """
+    if synchronous is not None:
+        _validate_pragmas([('synchronous', synchronous)])
+    DATASOURCE.write_behind_synchronous = synchronous
+    DATASOURCE.writer = BatchWriter(_write_messages, interval_secs,
+                                    batch_size)
+
+def release_connection():
+    """ Return the current request's connection to the pool """
+    if DATASOURCE is not None:
+        DATASOURCE.release()
+
+def check_pragmas():
+    """
+    Report which of the configured pragmas actually took effect
+
+    Returns a dict of pragma name to (requested, actual) values, and logs
+    a warning for each one that SQLite didn't accept (e.g. WAL on a
+    filesystem that doesn't support it, or mmap_size above the compiled
+    in limit).
+    """
+    report = {}
+    conn = _conn()
+    for name, requested in DATASOURCE.pragmas:
+        actual = conn.execute('PRAGMA %s' % (name,)).scalar()
+        actual = PRAGMA_VALUE_NAMES.get(name, {}).get(actual, actual)
+        report[name] = (requested, actual)
+        if str(actual).lower() != str(requested).lower():
+            LOGGER.warning('SQLite pragma %s requested %s but is %s',
+                           name, requested, actual)
+    LOGGER.info('SQLite pragmas in effect: %s',
+                ', '.join('%s=%s' % (name, actual)
+                          for name, (_, actual) in sorted(report.items())))
+    return report
+
+@_retry_when_busy
 def setup():
     """ Setup the database """
-    cursor = STATE['conn']
+    cursor = _conn()
     cursor.execute((
         'CREATE TABLE IF NOT EXISTS'
         ' messages (timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,'
-        ' nick varchar(256), message text, textDirection varchar(3))'))
+        ' nick varchar(256), message text, textDirection varchar(3),'
+        ' created integer)'))
     cursor.execute((
         'CREATE TABLE IF NOT EXISTS'
         ' message_stats (ltr integer, rtl integer)'))
+    # created (seconds since the epoch) was added so that expiry can be an
+    #  indexed range delete. Add and fill it in for older databases
+    columns = [row[1] for row in
+               cursor.execute('PRAGMA table_info(messages)').fetchall()]
+    if 'created' not in columns:
+        cursor.execute('ALTER TABLE messages ADD COLUMN created integer')
     cursor.execute((
         'CREATE INDEX IF NOT EXISTS'
-        ' timestamp_idx ON messages (timestamp)'))
-    STATE['messages_table'] = sqlalchemy.schema.MetaData(
-        STATE['conn'], reflect=True).tables['messages']
-    STATE['stats_table'] = sqlalchemy.schema.MetaData(
-        STATE['conn'], reflect=True).tables['message_stats']
+        ' created_idx ON messages (created)'))
+    cursor.execute((
+        'UPDATE messages'
+        ' SET created = cast(strftime(\'%s\', timestamp) as integer)'
+        ' WHERE created IS NULL'))
+    # Expiry no longer looks messages up by timestamp, and pages are read
+    #  in rowid order, so this index only slows down inserts
+    cursor.execute('DROP INDEX IF EXISTS timestamp_idx')
+    # Bumped whenever messages are deleted. Together with the newest rowid
+    #  this tells each worker whether its recent messages cache is current
+    cursor.execute((
+        'CREATE TABLE IF NOT EXISTS'
+        ' message_generation (deletes integer)'))
 
     # Initialize the stats table
     row = cursor.execute('select count(*) from message_stats').fetchone()
     if not row[0]:
-        ins = STATE['stats_table'].insert().values(ltr=0, rtl=0)
-        cursor.execute(ins)
-
-def commit():
-    """ Commit """
-    STATE['conn'].commit()
+        cursor.execute(MESSAGE_STATS.insert(), ltr=0, rtl=0)
+    row = cursor.execute('select count(*) from message_generation').fetchone()
+    if not row[0]:
+        cursor.execute('insert into message_generation (deletes) values (0)')
+    DATASOURCE.text_direction.flush()
+    atexit.register(shutdown)
 
 def close():
-    """ Close database connection """
-    STATE['conn'].close()
-    del STATE['conn']
-    del STATE['cursor']
-    STATE['connected'] = False
+    """ Close database connections """
+    DATASOURCE.close()
 
+@_retry_when_busy
 def record_count():
     """ Queries count of messages """
 
-    row = STATE['conn'].execute(
-        'select count(*) from messages').fetchone()
+    row = _conn().execute(COUNT_MESSAGES).fetchone()
     return row[0]
 
+@_retry_when_busy
+def latest_message_id():
+    """ Queries the id of the newest message, or 0 if there are none """
+
+    row = _conn().execute(LATEST_MESSAGE_ID).fetchone()
+    return row[0] or 0
+
+@_retry_when_busy
+def generation():
+    """
+    Identifies the current contents of the messages table
+
+    Changes with every insert (via the newest rowid) and every delete
+    (via message_generation), whichever worker made it.
+    """
+    now = time.time()
+    row = _conn().execute(SELECT_GENERATION).fetchone()
+    current = (row[0] or 0, row[1])
+    DATASOURCE.generation_snapshot = (now, current)
+    return current
+
+def cached_generation():
+    """
+    The generation, as read within the last GENERATION_CHECK_SECS
+
+    Cheap enough to check on every request. Changes made by other
+    workers may take up to GENERATION_CHECK_SECS to show.
+    """
+    snapshot = DATASOURCE.generation_snapshot
+    if snapshot is None or time.time() - snapshot[0] >= GENERATION_CHECK_SECS:
+        return generation()
+    return snapshot[1]
+
 def delete_records(max_age_hours=3):
-    """ Delete stale records """
-
-    STATE['conn'].execute((
-        'delete from messages where '
-        '24 * (julianday(\'now\') - julianday(timestamp)) > ?'), [max_age_hours])
-
-def query_messages(since=0, limit=25, offset=0):
-    """
-    Query record count for a given date and resource
-    """
-    cursor = STATE['conn']
-    results = []
-    for row in cursor.execute((
-            'SELECT rowid, cast(strftime(\'%s\', timestamp) as integer), '
-            'nick, message, textDirection FROM messages '
-            'WHERE rowid > ? order by timestamp desc limit ? offset ?'),
-                              [since, limit, offset]):
-        message = dict()
-        message['id'] = row[0]
-        message['timestamp'] = row[1]
-        message['nick'] = row[2]
-        message['body'] = row[3]
-        message['textDirection'] = row[4]
-        results.append(message)
+    """
+    Delete stale records, returning how many were deleted
+
+    Messages are deleted in batches of DELETE_BATCH_SIZE, each in its own
+    transaction, so that posting isn't blocked for long while a large
+    backlog expires.
+    """
+    cutoff = int(time.time()) - max_age_hours * 3600
+    expected_generation = generation()
+    deleted = 0
+    batches = 0
+    while True:
+        batch_deleted = _delete_batch(cutoff)
+        if not batch_deleted:
+            break
+        deleted += batch_deleted
+        batches += 1
+        if batch_deleted < DELETE_BATCH_SIZE:
+            break
+    if batches:
+        DATASOURCE.generation_snapshot = None
+        DATASOURCE.recent.trim(cutoff, expected_generation,
+                               (expected_generation[0],
+                                expected_generation[1] + batches))
+    return deleted
+
+@_retry_when_busy
+def _delete_batch(cutoff):
+    conn = _conn()
+    with conn.begin():
+        res = conn.execute(DELETE_EXPIRED_BATCH, cutoff=cutoff,
+                           limit=DELETE_BATCH_SIZE)
+        if res.rowcount:
+            conn.execute(BUMP_GENERATION)
+    return res.rowcount
+
+def query_messages(since=0, limit=25, offset=0, before_id=None):
+    """
+    Query the newest messages with since < id < before_id, newest first
+
+    Pages are keyed on rowid, which is the key SQLite stores the table
+    in, so each page is a single range scan however long the history is.
+    To page back, pass the oldest id of the last page as before_id.
+    offset is still accepted, but is costly for deep pages.
+
+    The newest messages are served from the recent messages cache, which
+    is reloaded if another worker has changed the messages since it was
+    last read.
+    """
+    since = int(since)
+    recent = DATASOURCE.recent
+    if offset or limit > recent.size:
+        return _query_messages(since, limit, offset, before_id)
+
+    current_generation = generation()
+    if recent.generation != current_generation:
+        recent.load(_query_messages(0, recent.size, 0, None),
+                    current_generation)
+    results = recent.messages_after(since, limit, before_id)
+    if results is None:
+        results = _query_messages(since, limit, offset, before_id)
     return results
 
+@_retry_when_busy
+def _query_messages(since, limit, offset, before_id):
+    cursor = _conn()
+    if before_id is None:
+        # Beyond any rowid, so we have a single form of the query
+        before_id = 2 ** 63 - 1
+    return [Message._make(row) for row in cursor.execute(
+        SELECT_MESSAGES, since=since, before_id=before_id, limit=limit,
+        offset=offset)]
+
+@_retry_when_busy
+def _flush_text_direction_stats(ltr, rtl):
+    """ Add to the stored text direction counts, returning the totals """
+    conn = _conn()
+    with conn.begin():
+        if ltr or rtl:
+            conn.execute(ADD_TEXT_DIRECTION_STATS, ltr=ltr, rtl=rtl)
+        return tuple(conn.execute(SELECT_TEXT_DIRECTION_STATS).fetchone())
+
+def shutdown():
+    """ Write out anything still queued or counted in this process """
+    if DATASOURCE is None:
+        return
+    if DATASOURCE.writer is not None:
+        DATASOURCE.writer.close()
+    flush_text_direction_stats()
+
+def flush_text_direction_stats():
+    """ Store this worker's text direction counts """
+    if DATASOURCE is not None:
+        DATASOURCE.text_direction.flush()
+
 def query_defaultTextDirection():
     """
     Query text direction
+
+    Answered from this worker's counts, which pick up other workers'
+    counts from the database every STATS_FLUSH_SECS.
     """
-    cursor = STATE['conn']
-    row = cursor.execute('select ltr, rtl from message_stats').fetchone()
+    return DATASOURCE.text_direction.majority()
+
+@_retry_when_busy
+def _insert_messages(messages):
+    """ Insert messages in one transaction, returning their ids """
+    conn = _conn()
+    synchronous = DATASOURCE.write_behind_synchronous
+    default_synchronous = dict(DATASOURCE.pragmas).get('synchronous')
+    if synchronous is not None:
+        conn.execute('PRAGMA synchronous = %s' % (synchronous,))
+    try:
+        with conn.begin():
+            return [conn.execute(
+                INSERT_MESSAGE, nick=message.nick, message=message.body,
+                textDirection=message.textDirection,
+                created=message.timestamp).lastrowid
+                    for message in messages]
+    finally:
+        if synchronous is not None and default_synchronous is not None:
+            conn.execute('PRAGMA synchronous = %s' % (default_synchronous,))
 
-    return 'ltr' if row[0] >= row[1] else 'rtl'
+def _write_messages(messages):
+    """ Insert messages and note them in this worker's caches """
+    ids = _insert_messages(messages)
+    DATASOURCE.generation_snapshot = None
+    for message, message_id in zip(messages, ids):
+        DATASOURCE.recent.append(message._replace(id=message_id))
+        DATASOURCE.text_direction.record(message.textDirection)
+    return ids
 
 def insert_message(nick, message, textDirection):
     """
     Insert record
-    """
-    ins = STATE['messages_table'].insert().values(
-        nick=nick, message=message, textDirection=textDirection)
-    res = STATE['conn'].execute(ins)
 
-    ltr = 1 if textDirection == 'ltr' else 0
-    rtl = 1 if textDirection == 'rtl' else 0
-    STATE['conn'].execute(
-        'update message_stats set ltr = ltr + ?, rtl = rtl + ?',
-        ltr, rtl)
+    With write-behind enabled, this waits for the message's batch to be
+    committed.
+    """
+    message = Message(None, int(time.time()), nick, message, textDirection)
+    if DATASOURCE.writer is not None:
+        message_id = DATASOURCE.writer.submit(message)
+    else:
+        message_id = _write_messages([message])[0]
 
     return {
-        'id': res.lastrowid
+        'id': message_id
     }
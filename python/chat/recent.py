@@ -0,0 +1,101 @@
+"""
+In-process cache of the newest chat messages
+
+Nearly every poll asks for the messages newer than the newest one the
+client has, and those are almost always among the last few dozen. The
+cache holds the newest messages (as datasource.Message tuples) along
+with the database generation they were read at, so datasource can
+answer polls without running the message query as long as the
+generation hasn't moved on.
+"""
+
+import collections
+import threading
+
+RECENT_MESSAGES_SIZE = 100
+
+
+class RecentMessages(object):
+    """Ring buffer of the newest messages, oldest first"""
+
+    def __init__(self, size=RECENT_MESSAGES_SIZE):
+        self.size = size
+        self._messages = collections.deque(maxlen=size)
+        self._lock = threading.Lock()
+        # Generation the contents correspond to, or None if never loaded
+        self.generation = None
+        # True if there are no older messages in the database
+        self._complete = False
+
+    def load(self, messages, generation):
+        """Replace the contents with messages read from the database
+
+        messages must be the newest (up to size) messages, newest first,
+        read after generation. They're labelled with the newest id they
+        hold, as a message inserted in between (by this worker too) is
+        among them but not counted in generation.
+        """
+        with self._lock:
+            self._messages.clear()
+            self._messages.extend(reversed(messages))
+            self._complete = len(messages) < self.size
+            if messages and messages[0].id > generation[0]:
+                generation = (messages[0].id, generation[1])
+            self.generation = generation
+
+    def append(self, message):
+        """Add a newly inserted message
+
+        SQLite gives a new row the rowid after the current maximum, so if
+        this message directly follows our newest one then nobody else has
+        inserted in the meantime and the cache stays current. A message
+        that's already cached, having been loaded since it was inserted,
+        is ignored. Otherwise the cache is left to be reloaded.
+        """
+        with self._lock:
+            if self._messages and message.id <= self._messages[-1].id:
+                return
+            if self.generation is None or \
+                    self.generation[0] + 1 != message.id:
+                self.generation = None
+                return
+            if len(self._messages) == self.size:
+                self._complete = False
+            self._messages.append(message)
+            self.generation = (message.id, self.generation[1])
+
+    def trim(self, min_timestamp, expected_generation, generation):
+        """Drop messages older than min_timestamp after they're deleted
+
+        expected_generation is the generation read before the delete and
+        generation is what the delete should have moved it on to. If the
+        cache wasn't current beforehand, it is left to be reloaded.
+        """
+        with self._lock:
+            if self.generation != expected_generation:
+                self.generation = None
+                return
+            while self._messages and \
+                    self._messages[0].timestamp < min_timestamp:
+                self._messages.popleft()
+            self.generation = generation
+
+    def messages_after(self, since, limit, before_id=None):
+        """Newest-first messages with since < id < before_id, or None
+
+        None means the cache can't be sure it holds all of them.
+        """
+        with self._lock:
+            results = []
+            for message in reversed(self._messages):
+                if before_id is not None and message.id >= before_id:
+                    continue
+                if message.id <= since or len(results) == limit:
+                    return results
+                results.append(message)
+            # We ran out of cached messages before reaching since
+            return results if self._complete else None
+
+    def latest_id(self):
+        with self._lock:
+            return self._messages[-1].id if self._messages else 0
@@ -1,48 +1,301 @@
-from flask import jsonify, request
-from chat import datasource
+import functools
+import threading
+import time
+from flask import Response, request, stream_with_context
+from chat.stream import MessageBroker
+from jsonresponse import ResponseCache, dumps, json_body_response, \
+    json_response
+
+MESSAGES_PAGE_SIZE = 25
+# Longest time a long-poll request waits for a new message
+LONG_POLL_WAIT_SECS = 25
+# An event stream is closed after this long, and the client reconnects
+EVENT_STREAM_MAX_SECS = 300
+# Idle event streams send a comment this often to keep proxies happy
+EVENT_STREAM_KEEPALIVE_SECS = 15
+# Most requests that may be parked waiting for messages at once. Each one
+#  holds a worker thread (or the whole of a sync worker), so the default
+#  is none: the stream endpoint then only checks for new messages
+STREAM_MAX_WAITING = 0
+# When there's no room to park, event stream clients are asked to
+#  reconnect after this long
+STREAM_BUSY_RETRY_MS = 5000
+
+# chat.datasource, which brings in SQLAlchemy. It's imported, and the
+#  database set up, by the first chat request in each worker (or warm_up),
+#  so that workers start answering captive portal probes sooner
+datasource = None
+_datasource_lock = threading.Lock()
+# The settings given to register()
+_datasource_settings = {}
+
+def _ensure_datasource():
+    """ Import the datasource and set up the database, once per process """
+    global datasource
+    if datasource is not None:
+        return
+    with _datasource_lock:
+        if datasource is not None:
+            return
+        from chat import datasource as chat_datasource
+        settings = _datasource_settings
+        pool_size = settings['pool_size']
+        chat_datasource.open_connection(
+            settings['connection_info'](), settings['sqlite_pragmas'](),
+            chat_datasource.DEFAULT_POOL_SIZE if pool_size is None
+            else pool_size)
+        write_behind = settings['write_behind']()
+        if write_behind is not None:
+            chat_datasource.enable_write_behind(**write_behind)
+        chat_datasource.setup()
+        chat_datasource.check_pragmas()
+        datasource = chat_datasource
+        broker.seed()
+        datasource.release_connection()
+
+def warm_up():
+    """ Do the setup left for the first chat request now """
+    _ensure_datasource()
+
+def _with_datasource(view):
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        _ensure_datasource()
+        return view(*args, **kwargs)
+    return wrapper
+
+def _latest_message_id():
+    # Called while requests are parked, so don't hold on to a pooled
+    #  connection in between
+    try:
+        return datasource.latest_message_id()
+    finally:
+        datasource.release_connection()
+
+broker = MessageBroker(_latest_message_id)
+waiting_slots = threading.BoundedSemaphore(STREAM_MAX_WAITING)
+# Encoded bodies of the newest page, keyed on the datasource generation
+responses = ResponseCache()
+TEXT_DIRECTION_BODIES = dict(
+    (direction, dumps({'result': direction})) for direction in ('ltr', 'rtl'))
 
 def add_message(message):
-    return datasource.insert_message(
+    result = datasource.insert_message(
         message['nick'], message['body'], message['textDirection'])
+    broker.publish(result['id'])
+    return result
 
-def get_messages(max_id=None):
-    return datasource.query_messages(since=max_id)
+def get_messages(max_id=None, before_id=None, limit=MESSAGES_PAGE_SIZE):
+    return datasource.query_messages(since=max_id or 0, limit=limit,
+                                     before_id=before_id)
 
 def cleanup_messages():
-    before = datasource.record_count()
-    datasource.delete_records()
-    after = datasource.record_count()
-    return before - after
+    deleted = datasource.delete_records()
+    if deleted:
+        # The newest messages may have gone, and waiters must not be woken
+        #  for them
+        broker.seed()
+    return deleted
+
+def _new_messages(since, timeout):
+    """
+    Messages newer than since, waiting up to timeout for some, or []
+
+    The broker's newest id can belong to a message that has since been
+    deleted. Then nothing is found, so the id is read again from the
+    database and we go back to waiting.
+    """
+    deadline = time.time() + timeout
+    while broker.wait(since, deadline - time.time()):
+        messages = get_messages(max_id=since)
+        if messages:
+            return messages
+        broker.seed()
+        if time.time() >= deadline:
+            break
+    return []
+
+def encode_message(message):
+    """ JSON for a datasource.Message, built from the tuple's fields """
+    return b'{"id":%d,"timestamp":%s,"nick":%s,"body":%s,' \
+        b'"textDirection":%s}' % (
+            message.id, dumps(message.timestamp), dumps(message.nick),
+            dumps(message.body), dumps(message.textDirection))
+
+def encode_messages(messages):
+    return b'[' + b','.join([encode_message(m) for m in messages]) + b']'
+
+def _encode_page(result, after_id):
+    return b'{"result":%s,"next":%s,"prev":%d}' % (
+        encode_messages(result),
+        dumps(result[-1].id if len(result) == MESSAGES_PAGE_SIZE else None),
+        result[0].id if result else after_id)
+
+def _tagged_response(body, etag):
+    """
+    JSON response with a weak ETag
+
+    no-cache makes browsers revalidate each time rather than guess how
+    long the response stays fresh.
+    """
+    response = json_body_response(body, headers={'Cache-Control': 'no-cache'})
+    response.set_etag(etag, weak=True)
+    return response
+
+def _not_modified(etag):
+    response = Response(status=304, headers={'Cache-Control': 'no-cache'})
+    response.set_etag(etag, weak=True)
+    return response
 
 def messages_endpoint():
+    """
+    GET returns the newest page of messages, newest first
+
+    after_id (or its older name max_id) and before_id restrict the page
+    to ids between them. The response's next cursor is the before_id for
+    the page of older messages (null if this was the last page) and prev
+    is the after_id to use to fetch newer messages.
+
+    Pages carry a weak ETag made from the datasource generation, which
+    changes whenever messages are inserted or deleted. If-None-Match is
+    answered from this worker's cached generation, so unchanged pages get
+    a 304 without touching the database. Anything else reads the current
+    generation first, so it includes every worker's latest posts.
+    """
     result = None
     if request.method == 'GET':
-        max_id = request.args.get('max_id', 0)
-        result = get_messages(max_id=max_id)
-        if max_id != 0 and not result:
+        after_id_arg = 'after_id' if 'after_id' in request.args else 'max_id'
+        after_id = request.args.get(after_id_arg, 0, type=int)
+        before_id = request.args.get('before_id', None, type=int)
+        etag = '%d-%d' % datasource.cached_generation()
+        if request.if_none_match.contains_weak(etag):
+            return _not_modified(etag)
+        generation = datasource.generation()
+        etag = '%d-%d' % generation
+        if after_id_arg in request.args and after_id >= generation[0]:
+            # Nothing newer than after_id has been posted
+            return ('', 204)
+        if after_id_arg not in request.args and before_id is None:
+            # The newest page, which every client loads on opening chat
+            body = responses.get('newest', generation)
+            if body is None:
+                body = _encode_page(get_messages(), 0)
+                responses.put('newest', generation, body)
+            return _tagged_response(body, etag)
+        result = get_messages(max_id=after_id, before_id=before_id)
+        if after_id_arg in request.args and not result:
             return ('', 204)
+        return _tagged_response(_encode_page(result, after_id), etag)
     elif request.method == 'POST':
         payload = request.json or {}
         result = add_message(payload)
     elif request.method == 'DELETE':
         result = cleanup_messages()
 
-    return jsonify({'result': result})
+    return json_response({'result': result})
+
+def _event_stream(since):
+    if not waiting_slots.acquire(False):
+        yield 'retry: %d\n\n' % (STREAM_BUSY_RETRY_MS,)
+        return
+    try:
+        deadline = time.time() + EVENT_STREAM_MAX_SECS
+        while time.time() < deadline:
+            messages = _new_messages(since, EVENT_STREAM_KEEPALIVE_SECS)
+            if not messages:
+                yield ': keepalive\n\n'
+                continue
+            # Send oldest first, so the client's event id ends at the newest
+            for message in reversed(messages):
+                since = max(since, message.id)
+                yield b'id: %d\ndata: %s\n\n' % (message.id,
+                                                  encode_message(message))
+            datasource.release_connection()
+    finally:
+        waiting_slots.release()
+
+def stream_endpoint():
+    """
+    Wait for messages newer than max_id
+
+    Clients that accept text/event-stream get Server-Sent Events for each
+    new message. Everyone else gets a long-poll: the same response as
+    GET /chat/messages as soon as there are new messages, or a 204 if
+    there are none within LONG_POLL_WAIT_SECS.
+
+    If STREAM_MAX_WAITING requests are already parked, long-polls are
+    answered straight away and event streams are asked to reconnect later.
+    """
+    since = request.args.get('max_id', 0, type=int)
+    last_event_id = request.headers.get('Last-Event-ID', '')
+    if last_event_id.isdigit():
+        since = int(last_event_id)
+    if 'text/event-stream' in request.headers.get('Accept', ''):
+        return Response(stream_with_context(_event_stream(since)),
+                        mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache',
+                                 'X-Accel-Buffering': 'no'})
+
+    if waiting_slots.acquire(False):
+        try:
+            messages = _new_messages(since, LONG_POLL_WAIT_SECS)
+        finally:
+            waiting_slots.release()
+    elif datasource.generation()[0] > since:
+        messages = get_messages(max_id=since)
+    else:
+        messages = []
+    if not messages:
+        return ('', 204)
+    return json_body_response(
+        b'{"result":%s}' % (encode_messages(messages),))
 
 def textdirection_endpoint():
+    """
+    The more common text direction
+
+    The body only depends on the direction itself, so that is the ETag.
+    """
     text_direction = datasource.query_defaultTextDirection()
-    return jsonify({'result': text_direction})
+    if request.if_none_match.contains_weak(text_direction):
+        return _not_modified(text_direction)
+    return _tagged_response(TEXT_DIRECTION_BODIES[text_direction],
+                            text_direction)
 
-def register(app, chat_connection_info):
-    datasource.open_connection(chat_connection_info())
-    datasource.setup()
+def release_connection(_exception=None):
+    if datasource is not None:
+        datasource.release_connection()
+
+def register(app, chat_connection_info, chat_sqlite_pragmas=list,
+             chat_db_pool_size=None,
+             chat_write_behind=lambda: None,
+             chat_stream_max_waiting=STREAM_MAX_WAITING):
+    """
+    chat_write_behind returns None, or the keyword arguments for
+    datasource.enable_write_behind to batch inserts. chat_db_pool_size
+    defaults to datasource.DEFAULT_POOL_SIZE. Nothing is opened until the
+    first chat request (or warm_up)
+    """
+    global waiting_slots
+    waiting_slots = threading.BoundedSemaphore(chat_stream_max_waiting)
+    _datasource_settings.update(
+        connection_info=chat_connection_info,
+        sqlite_pragmas=chat_sqlite_pragmas,
+        pool_size=chat_db_pool_size,
+        write_behind=chat_write_behind)
+    app.teardown_appcontext(release_connection)
     app.add_url_rule(
         rule='/chat/messages',
         endpoint='messages_endpoint',
         methods=['GET', 'POST', 'DELETE'],
-        view_func=messages_endpoint)
+        view_func=_with_datasource(messages_endpoint))
+    app.add_url_rule(
+        rule='/chat/messages/stream',
+        endpoint='stream_endpoint',
+        methods=['GET'],
+        view_func=_with_datasource(stream_endpoint))
     app.add_url_rule(
         rule='/chat/messages/textDirection',
         endpoint='textdirection_endpoint',
         methods=['GET'],
-        view_func=textdirection_endpoint)
+        view_func=_with_datasource(textdirection_endpoint))
@@ -0,0 +1,101 @@
+"""
+Per-worker text direction counts for chat messages
+
+Every message used to add to the single row in message_stats, which
+doubled the cost of posting and made all posts queue on that one row.
+Instead each worker counts the directions of the messages it inserts
+and adds them to message_stats every STATS_FLUSH_SECS (and on exit),
+reading back the totals from all workers at the same time. The default
+text direction is the majority of those totals plus our unflushed
+counts, so it's answered without touching the database in between.
+
+The counts are also flushed as messages are recorded, once
+STATS_FLUSH_SECS have passed or STATS_FLUSH_RECORDS are waiting, so a
+worker killed without running its exit handlers (by the gunicorn timeout
+or SIGKILL) loses at most that much, however rarely the default text
+direction is asked for.
+"""
+
+import logging
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+STATS_FLUSH_SECS = 30
+# Unflushed counts that make record() flush before STATS_FLUSH_SECS
+STATS_FLUSH_RECORDS = 100
+
+
+class TextDirectionCounter(object):
+    """Counts of ltr and rtl messages, flushed to the database periodically"""
+
+    def __init__(self, flush_fn, flush_secs=STATS_FLUSH_SECS,
+                 flush_records=STATS_FLUSH_RECORDS):
+        """flush_fn(ltr, rtl) adds to the stored totals and returns them"""
+        self._flush_fn = flush_fn
+        self._flush_secs = flush_secs
+        self._flush_records = flush_records
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._totals = {'ltr': 0, 'rtl': 0}
+        # Counts not yet stored, and counts being stored right now
+        self._pending = {'ltr': 0, 'rtl': 0}
+        self._flushing = {'ltr': 0, 'rtl': 0}
+        self._last_flush = 0
+
+    def record(self, text_direction):
+        """Count a stored message, flushing the counts if they're due
+
+        Called after the message is stored, so a failed flush is only
+        logged; its counts are kept for the next one.
+        """
+        if text_direction not in self._pending:
+            return
+        with self._lock:
+            self._pending[text_direction] += 1
+            due = sum(self._pending.values()) >= self._flush_records or \
+                time.time() - self._last_flush >= self._flush_secs
+        # Leave it to a flush already under way in another thread
+        if not due or not self._flush_lock.acquire(False):
+            return
+        try:
+            self._flush_locked()
+        except Exception:
+            LOGGER.exception('Could not store text direction counts')
+        finally:
+            self._flush_lock.release()
+
+    def flush(self):
+        """Store our counts and pick up everyone else's"""
+        with self._flush_lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        """flush(), with _flush_lock held"""
+        with self._lock:
+            flushing = self._flushing = self._pending
+            self._pending = {'ltr': 0, 'rtl': 0}
+            self._last_flush = time.time()
+        try:
+            ltr, rtl = self._flush_fn(flushing['ltr'], flushing['rtl'])
+        except Exception:
+            # Keep the counts to try again at the next flush
+            with self._lock:
+                for direction, count in flushing.items():
+                    self._pending[direction] += count
+                self._flushing = {'ltr': 0, 'rtl': 0}
+            raise
+        with self._lock:
+            self._totals = {'ltr': ltr, 'rtl': rtl}
+            self._flushing = {'ltr': 0, 'rtl': 0}
+
+    def majority(self):
+        """ltr or rtl, whichever is more common (ltr if tied)"""
+        if time.time() - self._last_flush >= self._flush_secs:
+            self.flush()
+        with self._lock:
+            ltr = self._totals['ltr'] + self._flushing['ltr'] + \
+                self._pending['ltr']
+            rtl = self._totals['rtl'] + self._flushing['rtl'] + \
+                self._pending['rtl']
+        return 'ltr' if ltr >= rtl else 'rtl'
@@ -0,0 +1,77 @@
+"""
+Delivery of new chat messages to clients that are waiting for them
+
+Rather than polling /chat/messages, clients can park a request on
+/chat/messages/stream until a message newer than the one they have seen
+is posted. Messages posted through this worker are published to a
+MessageBroker, which wakes every waiting request; the messages
+themselves are then read through datasource.query_messages, which serves
+them from the recent messages ring buffer. Messages posted through other
+workers are only visible in the database, so the broker also checks the
+newest message id there, at most once per poll interval however many
+requests are waiting. That check also notices when the newest messages
+have been deleted, so the newest id can go down as well as up.
+
+Parked requests tie up a sync gunicorn worker for their whole wait, so
+these endpoints are intended for threaded or async worker classes.
+"""
+
+import threading
+import time
+
+DATABASE_POLL_SECS = 1.0
+
+
+class MessageBroker(object):
+    """Tracks the newest message id and lets requests wait for a newer one"""
+
+    def __init__(self, latest_id_fn, database_poll_secs=DATABASE_POLL_SECS):
+        """latest_id_fn returns the newest message id in the database"""
+        self._latest_id_fn = latest_id_fn
+        self._database_poll_secs = database_poll_secs
+        self._condition = threading.Condition()
+        self._latest_id = 0
+        self._last_database_poll = 0
+
+    def seed(self):
+        """Take the newest message id from the database, e.g. after deletes"""
+        with self._condition:
+            self._latest_id = self._latest_id_fn()
+            self._last_database_poll = time.time()
+
+    def publish(self, message_id):
+        """Note a newly inserted message and wake everyone waiting"""
+        with self._condition:
+            self._latest_id = max(self._latest_id, message_id)
+            self._condition.notify_all()
+
+    def _poll_database(self):
+        """Notice messages inserted by other workers. Caller holds lock"""
+        now = time.time()
+        if now - self._last_database_poll < self._database_poll_secs:
+            return
+        self._last_database_poll = now
+        latest_id = self._latest_id_fn()
+        if latest_id > self._latest_id:
+            self._condition.notify_all()
+        # Lower if the newest messages have been deleted
+        self._latest_id = latest_id
+
+    def latest_id(self):
+        return self._latest_id
+
+    def wait(self, since, timeout):
+        """Block until there's a message newer than since, or timeout
+
+        Returns True if there is a newer message.
+        """
+        deadline = time.time() + timeout
+        with self._condition:
+            while self._latest_id <= since:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(
+                    min(remaining, self._database_poll_secs))
+                self._poll_database()
+            return True
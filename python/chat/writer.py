@@ -0,0 +1,119 @@
+"""
+Write-behind batching of chat message inserts
+
+Committing each posted message on its own costs a sync to the SD card
+per message, and when a whole room posts at once the posts queue up
+behind each other's syncs. With write-behind enabled, posted messages are
+queued and a background thread inserts whatever has queued up in a
+single transaction, once batch_size messages are waiting or interval_secs
+after the first of them arrived. Each poster waits for the commit of its
+batch, so it still gets the message's id back and a post that has been
+answered is as durable as the batch's synchronous setting makes it.
+"""
+
+import os
+import threading
+import time
+
+WRITE_BEHIND_INTERVAL_SECS = 0.005
+WRITE_BEHIND_BATCH_SIZE = 50
+
+
+class _Pending(object):
+    """A queued item, and what became of it"""
+
+    def __init__(self, item):
+        self.item = item
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class BatchWriter(object):
+    """Queues items and writes them in batches from a background thread"""
+
+    def __init__(self, write_fn, interval_secs=WRITE_BEHIND_INTERVAL_SECS,
+                 batch_size=WRITE_BEHIND_BATCH_SIZE):
+        """write_fn(items) writes items in one go, returning their results"""
+        self._write_fn = write_fn
+        self._interval_secs = interval_secs
+        self._batch_size = batch_size
+        self._condition = threading.Condition()
+        self._queue = []
+        self._thread = None
+        self._thread_pid = None
+        self._closed = False
+
+    def _ensure_thread(self):
+        """Start the flusher in this process. Caller holds lock
+
+        Threads don't survive a fork, so each worker starts its own.
+        """
+        if self._thread_pid != os.getpid():
+            self._queue = []
+            self._thread = threading.Thread(target=self._run,
+                                            name="chat-write-behind")
+            self._thread.daemon = True
+            self._thread.start()
+            self._thread_pid = os.getpid()
+
+    def submit(self, item):
+        """Queue item, wait for its batch to be written, and return its result
+
+        Raises whatever writing the batch raised.
+        """
+        pending = _Pending(item)
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("Write-behind queue is closed")
+            self._ensure_thread()
+            self._queue.append(pending)
+            self._condition.notify_all()
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def _take_batch(self):
+        """Wait for a batch to be due and take it. Caller holds lock"""
+        while not self._queue and not self._closed:
+            self._condition.wait()
+        deadline = time.time() + self._interval_secs
+        while len(self._queue) < self._batch_size and not self._closed:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            self._condition.wait(remaining)
+        batch = self._queue[:self._batch_size]
+        del self._queue[:self._batch_size]
+        return batch
+
+    def _write(self, batch):
+        try:
+            results = self._write_fn([pending.item for pending in batch])
+        except Exception as error:  # pylint: disable=broad-except
+            for pending in batch:
+                pending.error = error
+                pending.done.set()
+            return
+        for pending, result in zip(batch, results):
+            pending.result = result
+            pending.done.set()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                batch = self._take_batch()
+                if not batch:
+                    # Closed and drained
+                    return
+            self._write(batch)
+
+    def close(self):
+        """Write everything still queued and stop accepting items"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+            thread = self._thread if self._thread_pid == os.getpid() else None
+        if thread is not None:
+            thread.join()
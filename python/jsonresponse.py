@@ -0,0 +1,89 @@
+"""
+JSON responses without the overhead of flask.jsonify
+
+jsonify pretty-prints (unless the request is an XHR) and sorts keys,
+using the pure Python parts of the json module. Responses here are
+compact and use the fastest encoder that's installed: orjson, then
+ujson, then the standard library. Encoded bodies that are requested
+often can be kept in a ResponseCache, which drops them as soon as the
+data they were built from has changed.
+"""
+
+import json
+import threading
+from flask import Response
+
+# Escaping non-ASCII characters keeps any text encodable, including lone
+#  surrogates that orjson refuses
+_FALLBACK_ENCODER = json.JSONEncoder(separators=(',', ':'))
+
+
+def _fallback_dumps(obj):
+    return _FALLBACK_ENCODER.encode(obj).encode('ascii')
+
+try:
+    import orjson
+
+    def dumps(obj):
+        """Encode obj as UTF-8 JSON bytes"""
+        try:
+            return orjson.dumps(obj)
+        except orjson.JSONEncodeError:
+            return _fallback_dumps(obj)
+    ENCODER = 'orjson'
+except ImportError:
+    try:
+        import ujson
+
+        def dumps(obj):
+            """Encode obj as UTF-8 JSON bytes"""
+            try:
+                return ujson.dumps(obj).encode('ascii')
+            except ValueError:
+                return _fallback_dumps(obj)
+        ENCODER = 'ujson'
+    except ImportError:
+        dumps = _fallback_dumps
+        ENCODER = 'json'
+
+
+def json_body_response(body, status=200, headers=None):
+    """Response for an already encoded JSON body"""
+    return Response(body, status=status, headers=headers,
+                    mimetype='application/json')
+
+
+def json_response(obj, status=200, headers=None):
+    """Response with obj encoded as JSON"""
+    return json_body_response(dumps(obj), status, headers)
+
+
+class ResponseCache(object):
+    """Encoded response bodies, each valid for one generation of its data"""
+
+    def __init__(self):
+        self._bodies = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, generation):
+        """The body stored for key at generation, or None"""
+        entry = self._bodies.get(key)
+        if entry is None or entry[0] != generation:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[1]
+
+    def cache_info(self):
+        """(hits, misses) since this cache was created"""
+        return self.hits, self.misses
+
+    def put(self, key, generation, body):
+        with self._lock:
+            self._bodies[key] = (generation, body)
+
+    def clear(self):
+        with self._lock:
+            self._bodies.clear()
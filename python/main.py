@@ -1,19 +1,39 @@
+"""
+The connectbox app, as run by gunicorn (main:app)
+
+Modules that are slow to import (SQLAlchemy, ua_parser and requests) are
+left until something first needs them, or until WARM_UP_SECS after the
+worker starts, so that a freshly booted worker starts answering as soon
+as possible. Probes whose user agent isn't recognised as one (e.g.
+current Android's, and the iOS browser's request) still need ua_parser,
+so the first of them pays for importing it if it comes before the warm
+up. Run this with --startup-profile to see where startup time goes.
+"""
+import contextlib
+import locale
+import logging
 import os
+import sys
+import threading
+import time
 from six.moves import configparser
 
 from flask import Flask
-from captive_portal.manager import setup_captive_portal_app, show_captive_portal_welcome
-from chat.server import register as register_chat
-from admin.api import register as register_admin
+from captive_portal.clients import create_registry
+from captive_portal.manager import (
+    setup_captive_portal_app, show_captive_portal_welcome,
+    get_dhcp_lease_secs, refresh_real_connectbox_url, link_type_cache_info,
+    warm_up as warm_up_captive_portal)
+from chat.server import register as register_chat, \
+    responses as chat_responses, warm_up as warm_up_chat
+from admin.api import register as register_admin, add_property_change_listener
+from admin import config_reader
+import metrics
+import profiling
 
-# Ubuntu CI may not have locale set (see #134)
-import locale
-if locale.getlocale()[1] != "UTF-8":
-    local_lang = locale.getlocale()[0]
-    if local_lang is None:
-        locale.setlocale(locale.LC_ALL, "C.UTF-8")
-    else:
-        locale.setlocale(locale.LC_ALL, local_lang + ".UTF-8")
+LOGGER = logging.getLogger(__name__)
+# (step, seconds) for each step of create_app, for --startup-profile
+STARTUP_STEPS = []
 
 
 config_parser = configparser.ConfigParser()
@@ -21,25 +41,137 @@ config_parser.readfp(open('%s/defaults.cfg' % os.path.dirname(os.path.abspath(__
 config_parser.read(['/usr/local/connectbox/etc/connectbox.conf'])
 
 DATABASE_DIRECTORY = config_parser.get('main', 'DATABASE_DIRECTORY')
+LINK_TYPE_CACHE_SIZE = config_parser.getint('captive_portal',
+                                            'LINK_TYPE_CACHE_SIZE')
+CLIENT_REGISTRY = config_parser.get('captive_portal', 'CLIENT_REGISTRY')
+CLIENT_REGISTRY_MAX_ENTRIES = config_parser.getint(
+    'captive_portal', 'CLIENT_REGISTRY_MAX_ENTRIES')
+CHAT_DB_POOL_SIZE = config_parser.getint('chat', 'DB_POOL_SIZE')
+CHAT_STREAM_MAX_WAITING = config_parser.getint('chat', 'STREAM_MAX_WAITING')
+ADMIN_COMMAND_TIMEOUT_SECS = config_parser.getint('admin',
+                                                  'COMMAND_TIMEOUT_SECS')
+METRICS_ENABLED = config_parser.getboolean('metrics', 'ENABLED')
+METRICS_DIRECTORY = config_parser.get('metrics', 'DIRECTORY')
+PROFILING_ENABLED = config_parser.getboolean('profiling', 'ENABLED')
+WARM_UP_SECS = config_parser.getfloat('main', 'WARM_UP_SECS')
 
 def chat_connection_info():
     """ get db connection info string """
     return 'sqlite:///%s/cbchat.db' % (DATABASE_DIRECTORY)
 
-app = Flask(__name__)
+def chat_sqlite_pragmas():
+    """ get the SQLite pragmas to set on chat db connections """
+    from chat.datasource import TUNABLE_PRAGMAS
+    return [(pragma, config_parser.get('chat', 'SQLITE_%s' % pragma.upper()))
+            for pragma in TUNABLE_PRAGMAS]
+
+def chat_write_behind():
+    """ get the write-behind settings for chat inserts, or None if off """
+    if not config_parser.getboolean('chat', 'WRITE_BEHIND'):
+        return None
+    return {
+        'interval_secs':
+            config_parser.getint('chat', 'WRITE_BEHIND_INTERVAL_MS') / 1000.0,
+        'batch_size': config_parser.getint('chat', 'WRITE_BEHIND_BATCH_SIZE'),
+        'synchronous': config_parser.get('chat', 'WRITE_BEHIND_SYNCHRONOUS'),
+    }
+
+def profiling_settings():
+    """ get the settings for profiling.Profiler """
+    return {
+        'directory': config_parser.get('profiling', 'DIRECTORY'),
+        'max_bytes': config_parser.getint('profiling', 'MAX_MB') * 1024 * 1024,
+        'sample_rate': config_parser.getfloat('profiling', 'SAMPLE_RATE'),
+        'routes': [route.strip() for route in
+                   config_parser.get('profiling', 'ROUTES').split(',')
+                   if route.strip()],
+        'stack_sampler': config_parser.getboolean('profiling', 'STACK_SAMPLER'),
+        'stack_interval_secs':
+            config_parser.getint('profiling', 'STACK_INTERVAL_MS') / 1000.0,
+    }
+
+def client_registry_db_path():
+    """ get path of the shared captive portal client registry """
+    return '%s/cbclients.db' % (DATABASE_DIRECTORY)
 
-setup_captive_portal_app(app)
-register_chat(app, chat_connection_info)
-register_admin(app)
+def use_utf8_locale():
+    """ Ubuntu CI may not have locale set (see #134) """
+    language, encoding = locale.getlocale()
+    if encoding != "UTF-8":
+        if language is None:
+            locale.setlocale(locale.LC_ALL, "C.UTF-8")
+        else:
+            locale.setlocale(locale.LC_ALL, language + ".UTF-8")
+
+def on_admin_property_changed(prop):
+    """ keep state derived from admin-managed properties current """
+    if prop == 'hostname':
+        refresh_real_connectbox_url()
 
-# There's no simple way to set an error handler without using a decorator
-#  but that requires app to be defined at the top level, and before use of
-#  the decorator.
-@app.errorhandler(404)
 def default_view(_):
     """Handle all URLs and send them to the captive portal welcome page"""
     return show_captive_portal_welcome()
 
+def warm_up():
+    """ load what was left for first use, before a request needs it """
+    try:
+        warm_up_captive_portal()
+        warm_up_chat()
+    except Exception:  # pylint: disable=broad-except
+        # The first request that needs it will try again
+        LOGGER.exception("Warming up failed")
+
+@contextlib.contextmanager
+def _startup_step(step):
+    start = time.perf_counter()
+    yield
+    STARTUP_STEPS.append((step, time.perf_counter() - start))
+
+def create_app():
+    """ Build the app, leaving slow imports and the chat database for later """
+    with _startup_step('locale'):
+        use_utf8_locale()
+    new_app = Flask(__name__)
+    with _startup_step('captive_portal'):
+        setup_captive_portal_app(
+            new_app,
+            link_type_cache_size=LINK_TYPE_CACHE_SIZE,
+            client_registry=create_registry(CLIENT_REGISTRY,
+                                            get_dhcp_lease_secs,
+                                            CLIENT_REGISTRY_MAX_ENTRIES,
+                                            client_registry_db_path()))
+    with _startup_step('chat'):
+        register_chat(new_app, chat_connection_info, chat_sqlite_pragmas,
+                      CHAT_DB_POOL_SIZE, chat_write_behind,
+                      CHAT_STREAM_MAX_WAITING)
+    with _startup_step('admin'):
+        register_admin(new_app, ADMIN_COMMAND_TIMEOUT_SECS)
+        add_property_change_listener(on_admin_property_changed)
+    with _startup_step('profiling'):
+        profiling.register(new_app, PROFILING_ENABLED, **profiling_settings())
+    if METRICS_ENABLED:
+        with _startup_step('metrics'):
+            # Outermost, so it times everything, including ProxyFix
+            metrics.register(new_app, METRICS_DIRECTORY)
+            metrics.register_cache('link_type',
+                                   lambda: link_type_cache_info()[:2])
+            metrics.register_cache('chat_page', chat_responses.cache_info)
+            metrics.register_cache('admin_property', config_reader.cache_info)
+    new_app.register_error_handler(404, default_view)
+    if WARM_UP_SECS > 0:
+        timer = threading.Timer(WARM_UP_SECS, warm_up)
+        timer.daemon = True
+        timer.start()
+    return new_app
+
+if __name__ == "__main__" and "--startup-profile" in sys.argv[1:]:
+    # The profile is of a fresh interpreter, so don't build an app here
+    import startup_profile
+    sys.exit(startup_profile.main(
+        [arg for arg in sys.argv[1:] if arg != "--startup-profile"]))
+
+app = create_app()
+
 # @app.route('/foo')
 # def foo():
 #     return jsonify({'tasks': ['a','b','c']})
@@ -0,0 +1,435 @@
+"""
+Request timing and counters, shared by all gunicorn workers
+
+MetricsMiddleware wraps the WSGI app and records, for each endpoint,
+requests by status class, a latency histogram and the time spent in the
+chat database. Admin commands record their subprocess time, and caches
+registered with register_cache() report their hits and misses.
+
+Each worker keeps its values in its own memory mapped file in
+METRICS_DIRECTORY, with the names of the values in a JSON file beside
+it, so recording is a dict lookup and a float addition. GET /_metrics,
+from this machine only, adds up the files of every worker and answers in
+the Prometheus text format. The files of workers that have exited are
+added to a single file of retired totals and removed, when /_metrics is
+read and when a worker starts, so counters never go backwards and the
+directory doesn't grow with every worker restart. gunicorn's private
+/tmp is emptied when the service restarts, which is when counting
+starts again.
+"""
+
+import bisect
+import contextlib
+import fcntl
+import json
+import mmap
+import os
+import threading
+import time
+from flask import request
+from werkzeug.wsgi import ClosingIterator
+
+METRICS_DIRECTORY = "/tmp/connectbox-metrics"
+METRICS_PATH = "/_metrics"
+# Values each worker can hold. Further ones are dropped
+METRICS_SLOTS = 4096
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0)
+# How often each worker copies its cache statistics into its file
+CACHE_STATS_SYNC_SECS = 5
+# Reported for requests that didn't match a route, i.e. the 404 fallback
+UNMATCHED_ENDPOINT = "unmatched"
+ENDPOINT_ENVIRON_KEY = "connectbox.metrics.endpoint"
+LOCAL_ADDRESSES = ("127.0.0.1", "::1")
+# In METRICS_DIRECTORY. The lock is held exclusively while the files of
+#  exited workers are retired, and while a worker opens its own
+LOCK_NAME = "lock"
+RETIRED_NAME = "retired.totals"
+WORKER_SUFFIXES = (".values", ".json", ".json.tmp")
+
+HELP = {
+    "connectbox_http_requests_total": ("counter", "Requests answered"),
+    "connectbox_http_request_duration_seconds":
+        ("histogram", "Time taken to answer requests"),
+    "connectbox_http_request_db_seconds_total":
+        ("counter", "Chat database time spent answering requests"),
+    "connectbox_db_seconds_total":
+        ("counter", "Chat database time, in and out of requests"),
+    "connectbox_db_statements_total":
+        ("counter", "Chat database statements executed"),
+    "connectbox_subprocess_seconds_total":
+        ("counter", "Time spent running ConnectBoxManage.sh"),
+    "connectbox_subprocess_runs_total":
+        ("counter", "Runs of ConnectBoxManage.sh"),
+    "connectbox_cache_hits_total": ("counter", "Cache hits"),
+    "connectbox_cache_misses_total": ("counter", "Cache misses"),
+}
+
+STORE = None
+_caches = {}
+_request_state = threading.local()
+
+
+class WorkerMetrics(object):
+    """This worker's values, in its file in directory"""
+
+    def __init__(self, directory=METRICS_DIRECTORY, slots=METRICS_SLOTS):
+        self.directory = directory
+        self.slots = slots
+        self._lock = threading.Lock()
+        self._pid = None
+        self._index = {}
+        self._values = None
+        self._next_cache_sync = 0
+
+    def _open(self):
+        """Map this worker's file. Caller holds lock
+
+        Threads and mappings don't survive a fork usefully, so each
+        worker maps its own, retiring the files of exited workers first.
+        A file left by an exited worker with the same pid, not yet
+        retired, is carried on with.
+        """
+        path = os.path.join(self.directory, "worker-%d" % (os.getpid(),))
+        with _directory_lock(self.directory):
+            _retire_exited_workers(self.directory)
+            with open(path + ".values", "a+b") as values_file:
+                values_file.truncate(self.slots * 8)
+                mapped = mmap.mmap(values_file.fileno(), self.slots * 8)
+            self._index = {}
+            try:
+                with open(path + ".json") as index_file:
+                    self._index = dict((tuple(_as_key(key)), slot)
+                                       for key, slot in json.load(index_file))
+            except (OSError, ValueError):
+                pass
+        self._values = memoryview(mapped).cast("d")
+        self._pid = os.getpid()
+
+    def _slot(self, key):
+        """The slot holding key, allocating one if needed. Caller holds lock"""
+        slot = self._index.get(key)
+        if slot is None and len(self._index) < self.slots:
+            slot = self._index[key] = len(self._index)
+            path = os.path.join(self.directory, "worker-%d" % (self._pid,))
+            with open(path + ".json.tmp", "w") as index_file:
+                json.dump([[list(key), index]
+                           for key, index in self._index.items()],
+                          index_file)
+            os.rename(path + ".json.tmp", path + ".json")
+        return slot
+
+    def add(self, updates):
+        """Add each (key, amount) of updates to its value"""
+        with self._lock:
+            if self._pid != os.getpid():
+                self._open()
+            for key, amount in updates:
+                slot = self._index.get(key)
+                if slot is None:
+                    slot = self._slot(key)
+                    if slot is None:
+                        continue
+                self._values[slot] += amount
+
+    def set(self, updates):
+        """Set each (key, value) of updates"""
+        with self._lock:
+            if self._pid != os.getpid():
+                self._open()
+            for key, value in updates:
+                slot = self._slot(key)
+                if slot is not None:
+                    self._values[slot] = value
+
+    def sync_cache_stats(self, force=False):
+        """Copy the registered caches' statistics, at most so often"""
+        now = time.time()
+        if now < self._next_cache_sync and not force:
+            return
+        self._next_cache_sync = now + CACHE_STATS_SYNC_SECS
+        updates = []
+        for name, stats_fn in _caches.items():
+            hits, misses = stats_fn()
+            labels = (("cache", name),)
+            updates.append((("connectbox_cache_hits_total", labels), hits))
+            updates.append((("connectbox_cache_misses_total", labels),
+                            misses))
+        self.set(updates)
+
+
+def _as_key(stored_key):
+    """A key as read back from JSON: [name, [[label, value], ...]]"""
+    name, labels = stored_key
+    return name, tuple(tuple(label) for label in labels)
+
+
+@contextlib.contextmanager
+def _directory_lock(directory):
+    """Hold the lock on directory, creating it if needed"""
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, LOCK_NAME), "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+def _worker_pid(name):
+    """The pid of the worker a file in the directory belongs to, or None"""
+    prefix, _, pid = name.partition("-")
+    pid = pid.partition(".")[0]
+    if prefix != "worker" or not pid.isdigit() or \
+            not name.endswith(WORKER_SUFFIXES):
+        return None
+    return int(pid)
+
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # e.g. not ours to signal, but there
+        pass
+    return True
+
+
+def _read_worker(path):
+    """[(key, value)] from the files of a worker, [] if they're unreadable"""
+    try:
+        with open(path + ".json") as index_file:
+            index = json.load(index_file)
+        with open(path + ".values", "rb") as values_file:
+            data = values_file.read()
+    except (OSError, ValueError):
+        return []
+    values = memoryview(data).cast("d")
+    return [(_as_key(stored_key), values[slot])
+            for stored_key, slot in index if slot < len(values)]
+
+
+def _read_retired(directory):
+    """The retired totals, as a dict"""
+    try:
+        with open(os.path.join(directory, RETIRED_NAME)) as retired_file:
+            return dict((_as_key(key), value)
+                        for key, value in json.load(retired_file))
+    except (OSError, ValueError):
+        return {}
+
+
+def _retire_exited_workers(directory):
+    """Add the values of exited workers to the retired totals, removing
+    their files. Caller holds the directory lock"""
+    exited = set()
+    for name in os.listdir(directory):
+        pid = _worker_pid(name)
+        if pid is not None and pid not in exited and not _is_running(pid):
+            exited.add(pid)
+    if not exited:
+        return
+    totals = _read_retired(directory)
+    for pid in exited:
+        path = os.path.join(directory, "worker-%d" % (pid,))
+        for key, value in _read_worker(path):
+            totals[key] = totals.get(key, 0) + value
+    path = os.path.join(directory, RETIRED_NAME)
+    with open(path + ".tmp", "w") as retired_file:
+        json.dump([[list(key), value] for key, value in totals.items()],
+                  retired_file)
+    os.rename(path + ".tmp", path)
+    for pid in exited:
+        for suffix in WORKER_SUFFIXES:
+            try:
+                os.remove(os.path.join(directory, "worker-%d%s" % (
+                    pid, suffix)))
+            except FileNotFoundError:
+                pass
+
+
+def read_all(directory=METRICS_DIRECTORY):
+    """The sum of every worker's values, and the retired totals, keyed as
+    they were recorded"""
+    if not os.path.isdir(directory):
+        return {}
+    with _directory_lock(directory):
+        _retire_exited_workers(directory)
+        totals = _read_retired(directory)
+        for name in os.listdir(directory):
+            if name.endswith(".json") and _worker_pid(name) is not None:
+                path = os.path.join(directory, name[:-len(".json")])
+                for key, value in _read_worker(path):
+                    totals[key] = totals.get(key, 0) + value
+    return totals
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (
+        name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in labels)
+
+
+def _format_value(value):
+    return "%d" % value if value == int(value) else repr(value)
+
+
+def render_prometheus(totals):
+    """totals in the Prometheus text exposition format"""
+    by_metric = {}
+    for (name, labels), value in totals.items():
+        for suffix in ("_bucket", "_sum", "_count"):
+            if name.endswith(suffix) and name[:-len(suffix)] in HELP:
+                family = name[:-len(suffix)]
+                break
+        else:
+            family = name
+        by_metric.setdefault(family, []).append((name, labels, value))
+
+    lines = []
+    for family in sorted(by_metric):
+        kind, help_text = HELP.get(family, ("untyped", family))
+        lines.append("# HELP %s %s" % (family, help_text))
+        lines.append("# TYPE %s %s" % (family, kind))
+        samples = by_metric[family]
+        if kind == "histogram":
+            samples = _cumulative_buckets(samples)
+        for name, labels, value in sorted(samples, key=_sample_order):
+            lines.append("%s%s %s" % (name, _format_labels(labels),
+                                      _format_value(value)))
+    return "\n".join(lines) + "\n"
+
+
+def _sample_order(sample):
+    name, labels, _ = sample
+    labels = dict(labels)
+    le = labels.pop("le", None)
+    return (sorted(labels.items()), name,
+            float("inf") if le in (None, "+Inf") else float(le))
+
+
+def _cumulative_buckets(samples):
+    """Turn the per-bucket counts that are recorded into cumulative ones"""
+    others = []
+    buckets = {}
+    for name, labels, value in samples:
+        if name.endswith("_bucket"):
+            labels = dict(labels)
+            le = labels.pop("le")
+            buckets.setdefault((name, tuple(sorted(labels.items()))),
+                               {})[le] = value
+        else:
+            others.append((name, labels, value))
+    for (name, labels), counts in buckets.items():
+        total = 0
+        for bound in LATENCY_BUCKETS + (None,):
+            le = "+Inf" if bound is None else repr(bound)
+            total += counts.get(le, 0)
+            others.append((name, labels + (("le", le),), total))
+    return others
+
+
+def add_db_time(secs):
+    """Note secs spent on a chat database statement"""
+    if STORE is None:
+        return
+    _request_state.db_secs = getattr(_request_state, "db_secs", 0) + secs
+    STORE.add(((("connectbox_db_seconds_total", ()), secs),
+               (("connectbox_db_statements_total", ()), 1)))
+
+
+def add_subprocess_time(command, secs):
+    """Note secs spent running the manage script's command"""
+    if STORE is None:
+        return
+    labels = (("command", command),)
+    STORE.add(((("connectbox_subprocess_seconds_total", labels), secs),
+               (("connectbox_subprocess_runs_total", labels), 1)))
+
+
+def register_cache(name, stats_fn):
+    """Report stats_fn(), this worker's (hits, misses), for cache name"""
+    _caches[name] = stats_fn
+
+
+class MetricsMiddleware(object):
+    """Times each request, and answers local requests for METRICS_PATH"""
+
+    def __init__(self, wsgi_app, store):
+        self.wsgi_app = wsgi_app
+        self.store = store
+
+    def __call__(self, environ, start_response):
+        if environ.get("PATH_INFO") == METRICS_PATH and \
+                is_local_request(environ):
+            return self._serve_metrics(start_response)
+
+        start = time.perf_counter()
+        _request_state.db_secs = 0
+        status_holder = []
+
+        def recording_start_response(status, headers, exc_info=None):
+            status_holder.append(status)
+            return start_response(status, headers, exc_info)
+
+        def record():
+            elapsed_secs = time.perf_counter() - start
+            endpoint = environ.get(ENDPOINT_ENVIRON_KEY, UNMATCHED_ENDPOINT)
+            status = status_holder[0][:1] + "xx" if status_holder else "5xx"
+            self.record(endpoint, status, elapsed_secs,
+                        getattr(_request_state, "db_secs", 0))
+
+        try:
+            app_iter = self.wsgi_app(environ, recording_start_response)
+        except Exception:
+            record()
+            raise
+        return ClosingIterator(app_iter, record)
+
+    def record(self, endpoint, status, elapsed_secs, db_secs):
+        labels = (("endpoint", endpoint),)
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, elapsed_secs)
+        le = repr(LATENCY_BUCKETS[bucket]) \
+            if bucket < len(LATENCY_BUCKETS) else "+Inf"
+        self.store.add((
+            (("connectbox_http_requests_total",
+              (("endpoint", endpoint), ("status", status))), 1),
+            (("connectbox_http_request_duration_seconds_bucket",
+              (("endpoint", endpoint), ("le", le))), 1),
+            (("connectbox_http_request_duration_seconds_sum", labels),
+             elapsed_secs),
+            (("connectbox_http_request_duration_seconds_count", labels), 1),
+            (("connectbox_http_request_db_seconds_total", labels), db_secs),
+        ))
+        self.store.sync_cache_stats()
+
+    def _serve_metrics(self, start_response):
+        self.store.sync_cache_stats(force=True)
+        body = render_prometheus(read_all(self.store.directory)).encode(
+            "utf-8")
+        start_response("200 OK", [
+            ("Content-Type", "text/plain; version=0.0.4; charset=utf-8"),
+            ("Content-Length", str(len(body))),
+        ])
+        return [body]
+
+
+def is_local_request(environ):
+    """Whether the request came from this machine, not through nginx"""
+    return environ.get("REMOTE_ADDR") in LOCAL_ADDRESSES and \
+        "HTTP_X_FORWARDED_FOR" not in environ
+
+
+def register(app, directory=METRICS_DIRECTORY):
+    """Record metrics for app's requests, and serve them at METRICS_PATH"""
+    global STORE
+    STORE = WorkerMetrics(directory)
+
+    @app.teardown_request
+    def note_endpoint(_):
+        request.environ[ENDPOINT_ENVIRON_KEY] = \
+            request.endpoint or UNMATCHED_ENDPOINT
+
+    app.wsgi_app = MetricsMiddleware(app.wsgi_app, STORE)
@@ -0,0 +1,316 @@
+"""
+Opt-in profiling of a running app
+
+Two kinds of capture are written to PROFILE_DIRECTORY, which is kept
+under a size cap by removing the oldest captures:
+
+* cProfile statistics (.pstats, for pstats or snakeviz) of single
+  requests. A fraction of all requests can be sampled, and every request
+  to chosen routes captured. Routes are URL paths (e.g. /chat/messages)
+  or view names, where default_view stands for the requests no route
+  matched.
+* Collapsed stacks (.stacks, for flamegraph.pl or speedscope) from a
+  sampler that records what every thread of the worker is doing every
+  few milliseconds. It can run continuously, or for a while after a
+  worker is sent SIGUSR2 (a second SIGUSR2 stops it early). It only sees
+  OS threads, so it isn't started under gevent's worker class, whose
+  requests are greenlets.
+
+Routes and the stack sampler can also be switched on in every worker for
+a while by a request from the device itself, e.g.
+
+    curl 'http://127.0.0.1:5000/_profile?route=/chat/messages&secs=60'
+    curl 'http://127.0.0.1:5000/_profile?stacks=1&secs=60'
+"""
+
+import cProfile
+import collections
+import itertools
+import json
+import logging
+import os
+import random
+import signal
+import sys
+import threading
+import time
+from flask import g, request
+from jsonresponse import json_response
+from metrics import is_local_request
+
+PROFILE_DIRECTORY = "/tmp/connectbox-profiles"
+PROFILE_PATH = "/_profile"
+PROFILE_MAX_BYTES = 20 * 1024 * 1024
+STACK_INTERVAL_SECS = 0.01
+# Length of a capture started by SIGUSR2 or /_profile, and how often the
+#  continuous stack sampler writes out what it has
+CAPTURE_SECS = 60
+# The view that answers requests no route matched
+FALLBACK_VIEW = "default_view"
+# How often workers look for captures requested through PROFILE_PATH
+ARMED_CHECK_SECS = 1.0
+ARMED_FILE = "armed.json"
+CAPTURE_SUFFIXES = (".pstats", ".stacks")
+
+LOGGER = logging.getLogger(__name__)
+PROFILER = None
+# Tells apart captures written by a worker in the same millisecond
+_capture_numbers = itertools.count()
+
+
+def _threads_are_greenlets():
+    """Whether gevent has patched threading, as its gunicorn worker does"""
+    monkey = sys.modules.get("gevent.monkey")
+    return monkey is not None and monkey.is_module_patched("threading")
+
+
+def _capture_name(kind, suffix):
+    return "%s-%d-%d-%d%s" % (kind, os.getpid(), int(time.time() * 1000),
+                              next(_capture_numbers), suffix)
+
+
+class StackSampler(object):
+    """Counts the stacks of every other thread in this process"""
+
+    def __init__(self, profiler, interval_secs=STACK_INTERVAL_SECS):
+        self._profiler = profiler
+        self._interval_secs = interval_secs
+        self._lock = threading.Lock()
+        self._thread = None
+        self._thread_pid = None
+        # Sampling stops at this time.time(), or never if None
+        self._deadline = None
+
+    def running(self):
+        return self._thread_pid == os.getpid() and self._thread.is_alive()
+
+    def start(self, secs=None):
+        """Sample for secs, or until stopped. Extends a running capture"""
+        if _threads_are_greenlets():
+            LOGGER.warning("Not sampling stacks: under gevent, only the "
+                           "sampler's own stack could be seen")
+            return
+        with self._lock:
+            self._deadline = None if secs is None else time.time() + secs
+            if not self.running():
+                self._thread = threading.Thread(target=self._run,
+                                                name="stack-sampler")
+                self._thread.daemon = True
+                self._thread.start()
+                self._thread_pid = os.getpid()
+
+    def stop(self):
+        """Stop sampling, once what has been collected is written out"""
+        self._deadline = 0
+
+    def _run(self):
+        me = threading.get_ident()
+        counts = collections.Counter()
+        next_dump = time.time() + CAPTURE_SECS
+        while True:
+            time.sleep(self._interval_secs)
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != me:
+                    counts[_collapse(frame)] += 1
+            now = time.time()
+            deadline = self._deadline
+            if now >= next_dump or (deadline is not None and
+                                    now >= deadline):
+                self._profiler.write_stacks(counts)
+                counts = collections.Counter()
+                next_dump = now + CAPTURE_SECS
+                if deadline is not None and now >= deadline:
+                    return
+
+
+def _collapse(frame):
+    """frame's stack, outermost first, as flamegraph.pl expects"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append("%s:%s" % (os.path.basename(code.co_filename),
+                                code.co_name))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class Profiler(object):
+    """Decides which requests to profile, and writes out captures"""
+
+    def __init__(self, directory=PROFILE_DIRECTORY,
+                 max_bytes=PROFILE_MAX_BYTES, sample_rate=0.0, routes=(),
+                 stack_sampler=False, stack_interval_secs=STACK_INTERVAL_SECS):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.sample_rate = sample_rate
+        self.routes = frozenset(routes)
+        self.stack_sampler = stack_sampler
+        self.sampler = StackSampler(self, stack_interval_secs)
+        self._write_lock = threading.Lock()
+        # Routes captured on request through PROFILE_PATH, until a time
+        self._armed_routes = frozenset()
+        self._armed_until = 0
+        self._armed_signature = None
+        self._next_armed_check = 0
+
+    def _write(self, name, write_fn):
+        """Write a capture with write_fn(path), then enforce the size cap"""
+        with self._write_lock:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, name)
+            write_fn(path + ".tmp")
+            os.rename(path + ".tmp", path)
+            self._enforce_max_bytes()
+
+    def _enforce_max_bytes(self):
+        """Remove the oldest captures, of any worker, until under the cap"""
+        captures = []
+        for name in os.listdir(self.directory):
+            if name.endswith(CAPTURE_SUFFIXES):
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                captures.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in captures)
+        for _, size, path in sorted(captures):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def write_stacks(self, counts):
+        if not counts:
+            return
+
+        def write(path):
+            with open(path, "w") as stacks_file:
+                for stack, count in counts.most_common():
+                    stacks_file.write("%s %d\n" % (stack, count))
+        self._write(_capture_name("stacks", ".stacks"), write)
+
+    def write_profile(self, profile, route):
+        name = _capture_name("request-%s" % (
+            route.strip("/").replace("/", "_")[:64] or "root",), ".pstats")
+        self._write(name, profile.dump_stats)
+
+    def _check_armed(self):
+        """Pick up captures requested through PROFILE_PATH in any worker"""
+        now = time.time()
+        if now < self._next_armed_check:
+            return
+        self._next_armed_check = now + ARMED_CHECK_SECS
+        path = os.path.join(self.directory, ARMED_FILE)
+        try:
+            stat = os.stat(path)
+            signature = (stat.st_ino, stat.st_mtime_ns)
+            if signature == self._armed_signature:
+                return
+            with open(path) as armed_file:
+                armed = json.load(armed_file)
+        except (OSError, ValueError):
+            return
+        self._armed_signature = signature
+        self._armed_routes = frozenset(armed.get("routes", ()))
+        self._armed_until = armed.get("until", 0)
+        if armed.get("stacks") and armed["until"] > now:
+            self.sampler.start(armed["until"] - now)
+
+    def arm(self, routes, stacks, secs):
+        """Ask every worker to capture routes, and stacks if set, for secs"""
+        armed = {"routes": list(routes), "stacks": stacks,
+                 "until": time.time() + secs}
+
+        def write(path):
+            with open(path, "w") as armed_file:
+                json.dump(armed, armed_file)
+        with self._write_lock:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, ARMED_FILE)
+            write(path + ".tmp")
+            os.rename(path + ".tmp", path)
+        self._next_armed_check = 0
+        return armed
+
+    def wants(self, route, view):
+        """Whether to profile a request for route, handled by view"""
+        if route in self.routes or view in self.routes:
+            return True
+        if self._armed_until > time.time() and \
+                (route in self._armed_routes or view in self._armed_routes):
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def before_request(self):
+        if request.path == PROFILE_PATH and is_local_request(request.environ):
+            return self.serve_arm()
+        if self.stack_sampler and not self.sampler.running():
+            # The continuous sampler's thread is started in each worker
+            self.sampler.start()
+        self._check_armed()
+        view = request.endpoint or FALLBACK_VIEW
+        if not self.wants(request.path, view):
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another thread's request is being profiled, on Pythons that
+            #  allow one profiler at a time
+            return None
+        g.profile = profile
+        return None
+
+    def teardown_request(self, _):
+        profile = g.pop("profile", None)
+        if profile is not None:
+            profile.disable()
+            self.write_profile(profile, request.path)
+
+    def serve_arm(self):
+        """Arm captures from the ?route=, ?stacks= and ?secs= parameters"""
+        try:
+            secs = float(request.args.get("secs", CAPTURE_SECS))
+        except ValueError:
+            secs = CAPTURE_SECS
+        armed = self.arm(request.args.getlist("route"),
+                         bool(request.args.get("stacks")), secs)
+        return json_response({"result": armed})
+
+
+def _toggle_stack_capture():
+    if PROFILER.sampler.running():
+        PROFILER.sampler.stop()
+    else:
+        PROFILER.sampler.start(CAPTURE_SECS)
+
+
+def _on_sigusr2(*_):
+    # The interrupted code may hold the sampler's lock (e.g. a request
+    #  starting an armed capture), so toggle from another thread
+    thread = threading.Thread(target=_toggle_stack_capture,
+                              name="stack-sampler-toggle")
+    thread.daemon = True
+    thread.start()
+
+
+def register(app, enabled=False, **settings):
+    """Set up profiling as configured. settings are Profiler's arguments
+
+    The SIGUSR2 stack capture is available even when profiling is not
+    enabled, as it costs nothing until used. It can only be set up when
+    the app is loaded in the main thread, as gunicorn workers do.
+    """
+    global PROFILER
+    PROFILER = Profiler(**settings)
+    try:
+        signal.signal(signal.SIGUSR2, _on_sigusr2)
+    except ValueError:
+        pass
+    if enabled:
+        app.before_request(PROFILER.before_request)
+        app.teardown_request(PROFILER.teardown_request)
@@ -0,0 +1,172 @@
+"""
+Where the time goes when a worker loads main:app
+
+Loads main in a fresh interpreter under python -X importtime, so that
+nothing already imported hides the cost, and reports the slowest
+modules, the time by top level package, and the steps of create_app().
+With --first-requests it then times a captive portal probe and a chat
+request, which pay for whatever was left for first use:
+
+    python main.py --startup-profile
+    python startup_profile.py --first-requests --json
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+APP_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+# Run in the child. main's warm-up timer is cancelled, so the first
+#  requests pay for everything left for first use, and any other thread
+#  main started (e.g. the connectbox URL lookup) is waited for, so that
+#  no other thread is importing while they are timed
+CHILD_SCRIPT = """
+import json, sys, threading, time
+start = time.perf_counter()
+import main
+result = {"import_main_secs": time.perf_counter() - start,
+          "steps": main.STARTUP_STEPS, "first_requests": []}
+for thread in threading.enumerate():
+    if isinstance(thread, threading.Timer):
+        thread.cancel()
+    elif thread is not threading.current_thread():
+        thread.join(%(thread_wait_secs)r)
+if %(first_requests)r:
+    sys.stderr.write("%(marker)s\\n")
+    client = main.app.test_client()
+    for name, path, headers in %(requests)r:
+        start = time.perf_counter()
+        status = client.get(path, headers=headers).status_code
+        result["first_requests"].append(
+            (name, status, time.perf_counter() - start))
+sys.stdout.write(json.dumps(result))
+"""
+# Longest to wait for each thread started by main
+THREAD_WAIT_SECS = 10
+# As nginx would send them. 192.0.2.1 is reserved for documentation
+FIRST_REQUESTS = [
+    ("captive_portal_probe", "/hotspot-detect.html",
+     {"User-Agent": "Mozilla/5.0 (iPhone; CPU iPhone OS 10_3_1 like Mac "
+                    "OS X) AppleWebKit/603.1.30 (KHTML, like Gecko) "
+                    "Mobile/14E304",
+      "X-Forwarded-For": "192.0.2.1"}),
+    ("chat_messages", "/chat/messages", {"X-Forwarded-For": "192.0.2.1"}),
+]
+TOP_MODULES = 25
+# Written to stderr by the child between loading main and the first
+#  requests, to tell apart the imports each caused
+FIRST_REQUESTS_MARKER = "startup_profile: first requests"
+
+
+def parse_importtime(stderr):
+    """[(module, self secs, cumulative secs)] from -X importtime output
+
+    main itself is left out, as what importtime reports for it is off,
+    and the import_main_secs and steps of the report cover it.
+    """
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3:
+            continue
+        try:
+            self_us, cumulative_us = int(fields[0]), int(fields[1])
+        except ValueError:
+            # The header line
+            continue
+        if fields[2].strip() == "main":
+            continue
+        modules.append((fields[2].strip(), self_us / 1e6,
+                        cumulative_us / 1e6))
+    return modules
+
+
+def by_package(modules):
+    """Total self time of modules, by top level package, slowest first"""
+    totals = {}
+    for name, self_secs, _ in modules:
+        package = name.split(".")[0]
+        totals[package] = totals.get(package, 0) + self_secs
+    return sorted(totals.items(), key=lambda item: -item[1])
+
+
+def profile(first_requests=False):
+    """Load main in a fresh interpreter, returning what it took as a dict"""
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE="1")
+    child = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", CHILD_SCRIPT % {
+            "first_requests": first_requests,
+            "requests": FIRST_REQUESTS,
+            "marker": FIRST_REQUESTS_MARKER,
+            "thread_wait_secs": THREAD_WAIT_SECS}],
+        cwd=APP_DIRECTORY, env=env, stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    result = json.loads(child.stdout)
+    startup, _, first_requests = child.stderr.partition(
+        FIRST_REQUESTS_MARKER)
+    modules = parse_importtime(startup)
+    result["modules"] = sorted(modules, key=lambda module: -module[2])
+    result["packages"] = by_package(modules)
+    result["first_request_modules"] = sorted(
+        parse_importtime(first_requests), key=lambda module: -module[2])
+    return result
+
+
+def _module_lines(modules):
+    return ["  %8.3fs %8.3fs  %s" % (cumulative_secs, self_secs, name)
+            for name, self_secs, cumulative_secs in modules]
+
+
+def format_report(result, top=TOP_MODULES):
+    lines = ["import main: %.3fs" % (result["import_main_secs"],), "",
+             "Slowest modules (cumulative, self):"]
+    lines += _module_lines(result["modules"][:top])
+    lines += ["", "Slowest packages (self):"]
+    for package, secs in result["packages"][:top]:
+        lines.append("  %8.3fs  %s" % (secs, package))
+    lines += ["", "create_app() steps:"]
+    for step, secs in result["steps"]:
+        lines.append("  %8.3fs  %s" % (secs, step))
+    if result["first_requests"]:
+        lines += ["", "First requests (time, status):"]
+        for name, status, secs in result["first_requests"]:
+            lines.append("  %8.3fs %4d  %s" % (secs, status, name))
+        lines += ["", "Imported by the first requests (cumulative, self):"]
+        lines += _module_lines(result["first_request_modules"][:top])
+    return "\n".join(lines) + "\n"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--first-requests", action="store_true",
+                        help="also time a probe and a chat request")
+    parser.add_argument("--json", action="store_true",
+                        help="print the results as JSON")
+    parser.add_argument("--top", type=int, default=TOP_MODULES,
+                        help="modules and packages to list")
+    args = parser.parse_args(argv)
+    try:
+        result = profile(args.first_requests)
+    except subprocess.CalledProcessError as error:
+        sys.stderr.write(error.stderr)
+        return 1
+    if args.json:
+        json.dump(result, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        sys.stdout.write(format_report(result, args.top))
+    failed = [name for name, status, _ in result["first_requests"]
+              if status >= 400]
+    if failed:
+        # Their times aren't those of a working request
+        sys.stderr.write("First requests failed: %s\n" % (", ".join(failed),))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,7 +6,7 @@
 
 VERSION=0.1.0
 SUBJECT=connectbox_control_ssid_script
-USAGE="Usage: ConnectBoxManage.sh -dhv [get|set] [ssid|channel|hostname] <value>"
+USAGE="Usage: ConnectBoxManage.sh -dhv [get|set] [ssid|channel|hostname] <value> | getmany <property>..."
 HOSTAPD_CONFIG="/etc/hostapd/hostapd.conf"
 HOSTNAME_CONFIG="/etc/hostname"
 HOSTS_CONFIG="/etc/hosts"
@@ -646,6 +646,39 @@ if [ "$action" = "get" ]; then
       ;;
 
   esac
+elif [ "$action" = "getmany" ]; then
+  # Print each property as name=value, one per line
+  shift
+  for module in "$@"; do
+    case "$module" in
+      "ssid")
+        value=`get_ssid`
+        ;;
+
+      "channel")
+        value=`get_channel`
+        ;;
+
+      "hostname")
+        value=`get_hostname`
+        ;;
+
+      "staticsite")
+        value=`get_staticsite`
+        ;;
+
+      "ui-config")
+        value=`get_ui_config`
+        ;;
+
+      *)
+        usage
+        ;;
+
+    esac
+    echo "${module}=${value}"
+  done
+  exit 0;
 elif [ "$action" = "set" ]; then
   case "$module" in
     "ssid")
@@ -4,6 +4,7 @@ import os
 import unittest
 import random
 import requests
+import time
 
 TEST_IP_ENV_VAR = "TEST_IP"
 
@@ -475,11 +476,14 @@ class ConnectBoxDefaultVHostTestCase(unittest.TestCase):
 
 class ConnectBoxAPITestCase(unittest.TestCase):
 
+    ADMIN_API_URL = "%s/api" % (getAdminBaseURL(),)
     ADMIN_SSID_URL = "%s/api/ssid" % (getAdminBaseURL(),)
     ADMIN_HOSTNAME_URL = "%s/api/hostname" % (getAdminBaseURL(),)
     ADMIN_STATICSITE_URL = "%s/api/staticsite" % (getAdminBaseURL(),)
     SUCCESS_RESPONSE = ["SUCCESS"]
     BAD_REQUEST_TEXT = "BAD REQUEST"
+    # Longest to wait for a background write to finish
+    JOB_WAIT_SECS = 30
 
     @classmethod
     def setUpClass(cls):
@@ -506,6 +510,52 @@ class ConnectBoxAPITestCase(unittest.TestCase):
         r.raise_for_status()
         self.assertEqual(r.json()["code"], 0)
 
+    def testGetPropertyBatch(self):
+        r = requests.get(self.ADMIN_API_URL, auth=getAdminAuth(),
+                         params={"props": "ssid,staticsite"})
+        r.raise_for_status()
+        self.assertEqual(r.json()["code"], 0)
+        result = r.json()["result"]
+        self.assertEqual(sorted(result), ["ssid", "staticsite"])
+        # The same as reading them one at a time
+        r = requests.get(self.ADMIN_SSID_URL, auth=getAdminAuth())
+        r.raise_for_status()
+        self.assertEqual(result["ssid"], r.json()["result"])
+
+    def testBadRequestOnUnknownBatchProperty(self):
+        r = requests.get(self.ADMIN_API_URL, auth=getAdminAuth(),
+                         params={"props": "ssid,not_a_property"})
+        self.assertEqual(r.status_code, 400)
+
+    def testAsyncSSIDRoundTrip(self):
+        r = requests.get(self.ADMIN_SSID_URL, auth=getAdminAuth())
+        r.raise_for_status()
+        initial_ssid = r.json()["result"][0]
+        r = requests.put(self.ADMIN_SSID_URL, auth=getAdminAuth(),
+                         headers={"Prefer": "respond-async"},
+                         data=json.dumps({"value": initial_ssid}))
+        self.assertEqual(r.status_code, 202)
+        job_id = r.json()["result"]["job"]
+        self.assertTrue(r.headers["Location"].endswith("jobs/%s" % (job_id,)))
+
+        deadline = time.time() + self.JOB_WAIT_SECS
+        while True:
+            r = requests.get("%s/jobs/%s" % (self.ADMIN_API_URL, job_id),
+                             auth=getAdminAuth())
+            r.raise_for_status()
+            job = r.json()["result"]
+            self.assertIn(job["status"], ["queued", "running", "done"])
+            if job["status"] == "done" or time.time() > deadline:
+                break
+            time.sleep(0.5)
+        self.assertEqual(job["status"], "done")
+        self.assertEqual(job["code"], 0)
+        self.assertEqual(job["result"], self.SUCCESS_RESPONSE)
+
+        r = requests.get("%s/jobs/%s" % (self.ADMIN_API_URL, "0" * 32),
+                         auth=getAdminAuth())
+        self.assertEqual(r.status_code, 404)
+
     def testSSIDUnchRoundTrip(self):
         r = requests.get(self.ADMIN_SSID_URL, auth=getAdminAuth())
         initial_ssid = r.json()["result"][0]
@@ -608,6 +658,14 @@ class ConnectBoxAPITestCase(unittest.TestCase):
 class ConnectBoxChatTestCase(unittest.TestCase):
     CHAT_MESSAGES_URL = "%s/chat/messages" % (getTestBaseURL())
     CHAT_TEXT_DIRECTION_URL = "%s/chat/messages/textDirection" % (getTestBaseURL())
+    CHAT_STREAM_URL = "%s/chat/messages/stream" % (getTestBaseURL())
+    # MESSAGES_PAGE_SIZE in chat/server.py
+    MESSAGES_PAGE_SIZE = 25
+    # LONG_POLL_WAIT_SECS in chat/server.py
+    LONG_POLL_WAIT_SECS = 25
+    # GENERATION_CHECK_SECS in chat/datasource.py. A worker may answer
+    #  If-None-Match from a generation this old
+    GENERATION_CHECK_SECS = 1
 
     @classmethod
     def setUpClass(cls):
@@ -679,6 +737,94 @@ class ConnectBoxChatTestCase(unittest.TestCase):
         req = requests.get('%s?max_id=%d' % (self.CHAT_MESSAGES_URL, id2))
         self.assertEqual(req.status_code, 204)
 
+    def _post_messages(self, count):
+        ids = []
+        for n in range(count):
+            req = requests.post(self.CHAT_MESSAGES_URL,
+                json={"nick": "Foo", "body": "message %d" % (n,),
+                      "textDirection": "ltr"})
+            req.raise_for_status()
+            ids.append(req.json()['result']['id'])
+        return ids
+
+    def test_message_paging(self):
+        # One more than fits on the newest page
+        ids = self._post_messages(self.MESSAGES_PAGE_SIZE + 1)
+        newest_first = list(reversed(ids))
+
+        req = requests.get(self.CHAT_MESSAGES_URL)
+        req.raise_for_status()
+        response = req.json()
+        page_ids = [msg['id'] for msg in response['result']]
+        self.assertEqual(page_ids, newest_first[:self.MESSAGES_PAGE_SIZE])
+        # prev is the after_id for newer messages, next the before_id for
+        #  older ones
+        self.assertEqual(response['prev'], ids[-1])
+        self.assertEqual(response['next'], page_ids[-1])
+
+        req = requests.get('%s?before_id=%d' % (self.CHAT_MESSAGES_URL,
+                                                response['next']))
+        req.raise_for_status()
+        older_ids = [msg['id'] for msg in req.json()['result']]
+        self.assertEqual(older_ids[0], ids[0])
+
+        # Page back to the oldest message, whose page has no next cursor
+        while response['next'] is not None:
+            before_id = response['next']
+            req = requests.get('%s?before_id=%d' % (self.CHAT_MESSAGES_URL,
+                                                    before_id))
+            req.raise_for_status()
+            response = req.json()
+            page_ids = [msg['id'] for msg in response['result']]
+            self.assertTrue(all(msg_id < before_id for msg_id in page_ids))
+            self.assertEqual(page_ids, sorted(page_ids, reverse=True))
+        self.assertTrue(len(page_ids) <= self.MESSAGES_PAGE_SIZE)
+
+        # Both bounds at once
+        req = requests.get('%s?after_id=%d&before_id=%d' % (
+            self.CHAT_MESSAGES_URL, ids[0], ids[-1]))
+        req.raise_for_status()
+        response = req.json()
+        self.assertEqual([msg['id'] for msg in response['result']],
+                         newest_first[1:-1])
+        self.assertEqual(response['next'], None)
+        self.assertEqual(response['prev'], ids[-2])
+
+    def test_messages_etag(self):
+        self._post_messages(1)
+        req = requests.get(self.CHAT_MESSAGES_URL)
+        req.raise_for_status()
+        etag = req.headers['ETag']
+        self.assertTrue(etag.startswith('W/'))
+
+        req = requests.get(self.CHAT_MESSAGES_URL,
+                           headers={'If-None-Match': etag})
+        self.assertEqual(req.status_code, 304)
+        self.assertEqual(req.headers['ETag'], etag)
+
+        # A new message changes the tag
+        self._post_messages(1)
+        time.sleep(self.GENERATION_CHECK_SECS + 0.5)
+        req = requests.get(self.CHAT_MESSAGES_URL,
+                           headers={'If-None-Match': etag})
+        self.assertEqual(req.status_code, 200)
+        self.assertNotEqual(req.headers['ETag'], etag)
+
+    def test_stream_messages(self):
+        latest_id = self._post_messages(1)[0]
+        # Nothing newer, so a 204: straight away if no requests may wait
+        #  (STREAM_MAX_WAITING), otherwise after LONG_POLL_WAIT_SECS
+        req = requests.get('%s?max_id=%d' % (self.CHAT_STREAM_URL, latest_id),
+                           timeout=self.LONG_POLL_WAIT_SECS + 10)
+        self.assertEqual(req.status_code, 204)
+
+        new_id = self._post_messages(1)[0]
+        req = requests.get('%s?max_id=%d' % (self.CHAT_STREAM_URL, latest_id),
+                           timeout=self.LONG_POLL_WAIT_SECS + 10)
+        req.raise_for_status()
+        self.assertEqual([msg['id'] for msg in req.json()['result']],
+                         [new_id])
+
     def test_add_message(self):
         nick = "Foo"
         body = "message 1"